@@ -8,16 +8,28 @@
 - Автоматическое управление доступом
 """
 import os
+import sys
+import atexit
+import signal
 import sqlite3
 import time
 import threading
 import math
+import heapq
+import hmac
+import itertools
 import logging
 import re
 import random
+import secrets
 import string
+from collections import deque
 from datetime import datetime, timedelta
 import calendar
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import pytz
 import requests
 import telebot
@@ -30,13 +42,27 @@ load_dotenv()
 # ---------------- CONFIG ----------------
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 PROVIDER_TOKEN = os.environ.get("PROVIDER_TOKEN")
-ADMIN_IDS = [
+ADMIN_IDS = frozenset(
     int(x.strip()) for x in os.environ.get("ADMIN_IDS", "").split(",") if x.strip()
-]
+)
 CURRENCY = os.environ.get("CURRENCY", "BYN")
 REFERRAL_PERCENT = int(os.environ.get("REFERRAL_PERCENT", "10"))
 CHECK_INTERVAL_SECONDS = int(os.environ.get("CHECK_INTERVAL_SECONDS", "300"))
 DB_PATH = os.environ.get("DB_PATH", "student_bot.db")
+# Сколько секунд соединение ждёт снятия блокировки записи, прежде чем выдать
+# "database is locked" (у sqlite3.connect по умолчанию 5)
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", "10"))
+# Сколько обновлений обрабатываем параллельно (ответы Telegram не ждут друг друга)
+BOT_THREADS = int(os.environ.get("BOT_THREADS", "8"))
+# Webhook вместо long polling: задаётся публичный HTTPS-адрес (TLS - на reverse proxy),
+# без WEBHOOK_URL бот работает через polling, как раньше
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+# Без секрета любой, кто достучится до порта, мог бы прислать поддельный Update
+# (от имени админа или с successful_payment), поэтому если он не задан -
+# генерируем случайный на время работы и передаём его в set_webhook
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
 
 # Проверяем обязательные переменные
 if not BOT_TOKEN:
@@ -53,11 +79,37 @@ def now_local():
     return datetime.now(LOCAL_TZ)
 
 
+@lru_cache(maxsize=4096)
+def fmt_ts(ts, fmt="%Y-%m-%d %H:%M:%S"):
+    """Форматирует unix-время в локальной зоне (результат кэшируется)"""
+    return datetime.fromtimestamp(ts, LOCAL_TZ).strftime(fmt)
+
+
+def ttl_cache(seconds=300):
+    """Кэширует результат функции по аргументам на seconds секунд (есть cache_clear)"""
+
+    def decorator(fn):
+        cache = {}
+
+        def wrapper(*args):
+            hit = cache.get(args)
+            if hit and time.monotonic() < hit[0]:
+                return hit[1]
+            value = fn(*args)
+            cache[args] = (time.monotonic() + seconds, value)
+            return value
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
+
+
 # ----------------------------------------
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
-bot = telebot.TeleBot(BOT_TOKEN, threaded=True)
+bot = telebot.TeleBot(BOT_TOKEN, threaded=True, num_threads=BOT_THREADS)
 
 try:
     ME = bot.get_me()
@@ -69,13 +121,65 @@ except Exception as e:
 
 
 # ----------------- DB init + migrations -----------------
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-cursor = conn.cursor()
+# Каждый поток (обработчики бота, фоновые задачи) работает через своё
+# соединение: транзакция одного потока не коммитится и не откатывается чужим
+# commit/rollback или "with conn". WAL позволяет им читать параллельно
+_tls = threading.local()
+# Все открытые соединения - чтобы shutdown() закрыл и соединения рабочих потоков
+_all_conns = []
+_all_conns_lock = threading.Lock()
+
+
+def get_conn():
+    """Соединение с базой, принадлежащее текущему потоку"""
+    if not hasattr(_tls, "conn"):
+        _tls.conn = sqlite3.connect(
+            DB_PATH,
+            timeout=DB_BUSY_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        # WAL: чтения админки не блокируются записью подписок; кэш страниц побольше
+        _tls.conn.execute("PRAGMA journal_mode=WAL")
+        _tls.conn.execute("PRAGMA synchronous=NORMAL")
+        _tls.conn.execute("PRAGMA temp_store=MEMORY")
+        _tls.conn.execute("PRAGMA cache_size=-65536")
+        _tls.conn.execute("PRAGMA mmap_size=268435456")
+        with _all_conns_lock:
+            _all_conns.append(_tls.conn)
+    return _tls.conn
+
+
+class _ThreadConnection:
+    """conn для всего модуля: каждый вызов уходит в соединение текущего потока"""
+
+    def __getattr__(self, name):
+        return getattr(get_conn(), name)
+
+    def __enter__(self):
+        return get_conn().__enter__()
+
+    def __exit__(self, *exc_info):
+        return get_conn().__exit__(*exc_info)
+
+
+conn = _ThreadConnection()
+# Запросы идут через conn.execute: каждый вызов получает свой курсор, а
+# подготовленные выражения берутся из кэша соединения (cached_statements).
+# row_factory у соединения намеренно не задаём: строки остаются кортежами,
+# и горячие циклы (admin_list_plans и т.п.) распаковывают их без обращения по имени
+
+
+def row_query(sql, params=()):
+    """Выборка с доступом к колонкам по имени для широких админских запросов"""
+    cur = conn.execute(sql, params)
+    cur.row_factory = sqlite3.Row
+    return cur
 
 
 def init_db_and_migrate():
     # Таблица групп (чатов)
-    cursor.execute(
+    conn.execute(
         """
     CREATE TABLE IF NOT EXISTS managed_groups (
         chat_id INTEGER PRIMARY KEY,
@@ -88,7 +192,7 @@ def init_db_and_migrate():
     )
 
     # Таблица тарифов (планов)
-    cursor.execute(
+    conn.execute(
         """
     CREATE TABLE IF NOT EXISTS plans (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -107,7 +211,7 @@ def init_db_and_migrate():
     )
 
     # Таблица пользователей
-    cursor.execute(
+    conn.execute(
         """
     CREATE TABLE IF NOT EXISTS users (
         user_id INTEGER PRIMARY KEY,
@@ -120,7 +224,7 @@ def init_db_and_migrate():
     )
 
     # Таблица подписок (переработанная для ежемесячных платежей)
-    cursor.execute(
+    conn.execute(
         """
     CREATE TABLE IF NOT EXISTS subscriptions (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -143,7 +247,7 @@ def init_db_and_migrate():
     )
 
     # Таблица счетов
-    cursor.execute(
+    conn.execute(
         """
     CREATE TABLE IF NOT EXISTS invoices (
         payload TEXT PRIMARY KEY,
@@ -160,7 +264,7 @@ def init_db_and_migrate():
     )
 
     # Таблица медиа для тарифов
-    cursor.execute(
+    conn.execute(
         """
     CREATE TABLE IF NOT EXISTS plan_media (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -175,7 +279,7 @@ def init_db_and_migrate():
     )
 
     # Таблица методов оплаты
-    cursor.execute(
+    conn.execute(
         """
     CREATE TABLE IF NOT EXISTS payment_methods (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -189,7 +293,7 @@ def init_db_and_migrate():
     )
 
     # Таблица ручных платежей
-    cursor.execute(
+    conn.execute(
         """
     CREATE TABLE IF NOT EXISTS manual_payments (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -211,7 +315,7 @@ def init_db_and_migrate():
     )
 
     # Таблица промокодов
-    cursor.execute(
+    conn.execute(
         """
     CREATE TABLE IF NOT EXISTS promo_codes (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -228,7 +332,7 @@ def init_db_and_migrate():
     )
 
     # Таблица использования промокодов
-    cursor.execute(
+    conn.execute(
         """
     CREATE TABLE IF NOT EXISTS promo_usage (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -241,7 +345,7 @@ def init_db_and_migrate():
     )
 
     # Таблица категорий (предметов)
-    cursor.execute(
+    conn.execute(
         """
     CREATE TABLE IF NOT EXISTS categories (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -255,16 +359,44 @@ def init_db_and_migrate():
 
     # Добавляем поле category_id в таблицу планов
     try:
-        cursor.execute("ALTER TABLE plans ADD COLUMN category_id INTEGER")
+        conn.execute("ALTER TABLE plans ADD COLUMN category_id INTEGER")
     except sqlite3.OperationalError:
         pass  # Поле уже существует
 
+    # Индексы для админских выборок (заявки на оплату, медиа группы)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_mp_status_created ON manual_payments(status, created_ts)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_plan_media_plan_ord ON plan_media(plan_id, ord)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_promo_created ON promo_codes(created_ts DESC)"
+    )
+
+    # Индексы для выборок подписок в рассылках, очистке и проверке подписки
+    conn.execute(
+        """
+    CREATE INDEX IF NOT EXISTS idx_subs_active_end_period
+    ON subscriptions(active, end_ts, current_period_month, current_period_year, part_paid)
+    """
+    )
+    conn.execute(
+        """
+    CREATE INDEX IF NOT EXISTS idx_subs_user_plan_active
+    ON subscriptions(user_id, plan_id, active, end_ts DESC)
+    """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_subs_notif ON subscriptions(active, last_notification_ts)"
+    )
+
     conn.commit()
 
     # Инициализация методов оплаты если их нет
-    cursor.execute("SELECT COUNT(*) FROM payment_methods")
-    if cursor.fetchone()[0] == 0:
-        cursor.execute(
+    cur = conn.execute("SELECT COUNT(*) FROM payment_methods")
+    if cur.fetchone()[0] == 0:
+        conn.execute(
             """
         INSERT INTO payment_methods (name, type, is_active, description, details)
         VALUES 
@@ -274,6 +406,10 @@ def init_db_and_migrate():
         )
         conn.commit()
 
+    # Обновляем статистику, чтобы планировщик SQLite выбирал новые индексы
+    conn.execute("ANALYZE")
+    conn.commit()
+
 
 init_db_and_migrate()
 
@@ -307,10 +443,109 @@ def safe_caption(text, limit=1024):
     return text[: limit - 3] + "..."
 
 
+class RateLimiter:
+    """Token bucket под лимиты Telegram: общий (30/с) и на чат (20/мин)"""
+
+    def __init__(self, global_rate=30, chat_rate=20, chat_period=60):
+        self._lock = threading.Lock()
+        self._global_rate = global_rate
+        self._global_tokens = float(global_rate)
+        self._global_ts = time.monotonic()
+        self._chat_capacity = chat_rate
+        self._chat_refill = chat_rate / chat_period
+        # {chat_id: [tokens, ts, blocked_until]}
+        self._chats = {}
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Чаты с полным ведром и без блокировки ничего не ограничивают
+                self._chats = {
+                    cid: b
+                    for cid, b in self._chats.items()
+                    if b[2] > now
+                    or b[0] + (now - b[1]) * self._chat_refill < self._chat_capacity
+                }
+            bucket = self._chats[chat_id] = [float(self._chat_capacity), now, 0.0]
+        return bucket
+
+    def acquire(self, chat_id=None):
+        """Блокирует поток, пока не появится токен (общий и для чата)"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._global_tokens = min(
+                    self._global_rate,
+                    self._global_tokens + (now - self._global_ts) * self._global_rate,
+                )
+                self._global_ts = now
+                wait = max(0.0, (1 - self._global_tokens) / self._global_rate)
+
+                bucket = None
+                if chat_id is not None:
+                    bucket = self._chat_bucket(chat_id, now)
+                    bucket[0] = min(
+                        self._chat_capacity,
+                        bucket[0] + (now - bucket[1]) * self._chat_refill,
+                    )
+                    bucket[1] = now
+                    if bucket[2] > now:
+                        wait = max(wait, bucket[2] - now)
+                    else:
+                        wait = max(wait, (1 - bucket[0]) / self._chat_refill)
+
+                if wait <= 0:
+                    self._global_tokens -= 1
+                    if bucket is not None:
+                        bucket[0] -= 1
+                    return
+            time.sleep(wait)
+
+    def block_chat(self, chat_id, seconds):
+        """Откладывает отправку в чат после 429 (остальные чаты не ждут)"""
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._chat_bucket(chat_id, now)
+            bucket[2] = max(bucket[2], now + seconds)
+
+
+rate_limiter = RateLimiter()
+
+
+def telegram_retry_after(exc):
+    """Для ошибки 429 возвращает retry_after в секундах, иначе None"""
+    if (
+        isinstance(exc, telebot.apihelper.ApiTelegramException)
+        and exc.error_code == 429
+    ):
+        return (exc.result_json or {}).get("parameters", {}).get("retry_after", 1)
+    return None
+
+
+# Пул для уведомлений пользователям, чтобы админский UI не ждал ответа Telegram
+_notify_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="notify")
+
+
+def _safe_send(chat_id, text, **kwargs):
+    """Отправляет сообщение, не пробрасывая ошибки наружу"""
+    rate_limiter.acquire(chat_id)
+    try:
+        bot.send_message(chat_id, text, **kwargs)
+    except Exception as e:
+        logging.warning(f"Не удалось отправить сообщение {chat_id}: {e}")
+
+
+def notify_admins(text):
+    """Рассылает сообщение всем админам параллельно, не дожидаясь отправки"""
+    for aid in ADMIN_IDS:
+        _notify_pool.submit(_safe_send, aid, text)
+
+
 def add_user_if_not_exists(user_id, referred_by=None, username=None):
-    cursor.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,))
-    if cursor.fetchone() is None:
-        cursor.execute(
+    cur = conn.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,))
+    if cur.fetchone() is None:
+        conn.execute(
             "INSERT INTO users (user_id, referred_by, cashback_cents, username, join_date) VALUES (?, ?, 0, ?, ?)",
             (
                 user_id,
@@ -324,7 +559,7 @@ def add_user_if_not_exists(user_id, referred_by=None, username=None):
 
     # Обновляем username (без сетевых запросов к Telegram API)
     try:
-        cursor.execute(
+        conn.execute(
             "UPDATE users SET username = ? WHERE user_id = ?",
             (f"@{username}" if username else None, user_id),
         )
@@ -333,22 +568,36 @@ def add_user_if_not_exists(user_id, referred_by=None, username=None):
         pass
 
 
+# Кэш группы по умолчанию: {"chat_id": chat_id или None}
+_default_group_cache = {}
+
+
+def _invalidate_default_group():
+    """Сбрасывает кэш группы по умолчанию"""
+    _default_group_cache.clear()
+
+
 def get_default_group():
-    cursor.execute("SELECT chat_id FROM managed_groups WHERE is_default=1 LIMIT 1")
-    r = cursor.fetchone()
-    if r:
-        return r[0]
-    cursor.execute("SELECT chat_id FROM managed_groups LIMIT 1")
-    r = cursor.fetchone()
-    if r:
-        return r[0]
-    return None
+    if "chat_id" in _default_group_cache:
+        return _default_group_cache["chat_id"]
+
+    cur = conn.execute("SELECT chat_id FROM managed_groups WHERE is_default=1 LIMIT 1")
+    r = cur.fetchone()
+    if not r:
+        cur = conn.execute("SELECT chat_id FROM managed_groups LIMIT 1")
+        r = cur.fetchone()
+    _default_group_cache["chat_id"] = r[0] if r else None
+    return _default_group_cache["chat_id"]
 
 
 def set_default_group(chat_id):
-    cursor.execute("UPDATE managed_groups SET is_default=0")
-    cursor.execute("UPDATE managed_groups SET is_default=1 WHERE chat_id=?", (chat_id,))
-    conn.commit()
+    with conn:
+        conn.execute("UPDATE managed_groups SET is_default=0")
+        conn.execute(
+            "UPDATE managed_groups SET is_default=1 WHERE chat_id=?", (chat_id,)
+        )
+    invalidate_bot_admin_cache(chat_id)
+    _invalidate_default_group()
 
 
 def create_chat_invite_link_one_time(
@@ -377,59 +626,166 @@ def get_bot_invite_link():
     return f"https://t.me/{username}?startgroup=true"
 
 
+# Кэш статуса бота в чатах: {chat_id: (ts, is_admin)}
+BOT_ADMIN_CACHE_TTL = 60
+_bot_admin_cache = {}
+
+
+def invalidate_bot_admin_cache(chat_id=None):
+    """Сбрасывает кэш статуса бота для чата (или целиком)"""
+    if chat_id is None:
+        _bot_admin_cache.clear()
+    else:
+        _bot_admin_cache.pop(chat_id, None)
+
+
 def is_bot_admin_in_chat(chat_id):
     """Проверяет, является ли бот администратором в чате"""
+    cached = _bot_admin_cache.get(chat_id)
+    if cached and time.monotonic() - cached[0] < BOT_ADMIN_CACHE_TTL:
+        return cached[1]
+
     try:
         chat = bot.get_chat(chat_id)
         if chat.type in ["private", "channel"]:
-            return True  # Для каналов и приватных чатов считаем, что бот имеет доступ
-
-        member = bot.get_chat_member(chat_id, BOT_ID)
-        return member.status in ["administrator", "creator"]
+            is_admin = True  # Для каналов и приватных чатов считаем, что бот имеет доступ
+        else:
+            member = bot.get_chat_member(chat_id, BOT_ID)
+            is_admin = member.status in ["administrator", "creator"]
     except Exception as e:
         logging.warning(f"Can't check bot admin status in chat {chat_id}: {e}")
         return False
 
+    _bot_admin_cache[chat_id] = (time.monotonic(), is_admin)
+    return is_admin
+
 
 def add_group_to_db(chat_id, title, chat_type="group"):
     try:
-        cursor.execute(
-            "INSERT OR REPLACE INTO managed_groups (chat_id, title, type, added_date) VALUES (?, ?, ?, ?)",
-            (chat_id, title, chat_type, int(time.time())),
-        )
-        cursor.execute("SELECT COUNT(*) FROM managed_groups")
-        count = cursor.fetchone()[0]
-        if count == 1:
-            cursor.execute(
-                "UPDATE managed_groups SET is_default=1 WHERE chat_id=?", (chat_id,)
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO managed_groups (chat_id, title, type, added_date) VALUES (?, ?, ?, ?)",
+                (chat_id, title, chat_type, int(time.time())),
             )
-        conn.commit()
+            cur = conn.execute("SELECT COUNT(*) FROM managed_groups")
+            count = cur.fetchone()[0]
+            if count == 1:
+                conn.execute(
+                    "UPDATE managed_groups SET is_default=1 WHERE chat_id=?",
+                    (chat_id,),
+                )
+        invalidate_bot_admin_cache(chat_id)
+        _group_title_cache.pop(chat_id, None)
+        _invalidate_default_group()
+        get_all_groups_with_bot.cache_clear()
         return True
     except Exception as e:
         logging.exception("add_group_to_db error: %s", e)
         return False
 
 
+def remove_group_from_db(chat_id):
+    try:
+        conn.execute("DELETE FROM managed_groups WHERE chat_id=?", (chat_id,))
+        conn.commit()
+    except Exception as e:
+        logging.exception("remove_group_from_db error: %s", e)
+    invalidate_bot_admin_cache(chat_id)
+    _group_title_cache.pop(chat_id, None)
+    _invalidate_default_group()
+    get_all_groups_with_bot.cache_clear()
+
+
+# Кэш названий групп: {chat_id: title}
+_group_title_cache = {}
+
+
+def get_group_title(chat_id):
+    """Возвращает название группы из кэша или из БД (None, если группы нет)"""
+    title = _group_title_cache.get(chat_id)
+    if title is not None:
+        return title
+
+    cur = conn.execute("SELECT title FROM managed_groups WHERE chat_id=?", (chat_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    _group_title_cache[chat_id] = row[0]
+    return row[0]
+
+
+# Таблица маленькая: заполняем кэш названий сразу при старте
+_group_title_cache.update(
+    conn.execute("SELECT chat_id, title FROM managed_groups").fetchall()
+)
+
+
+def get_default_group_with_title():
+    """Группа по умолчанию и её название; (None, None), если групп нет"""
+    if "chat_id" in _default_group_cache:
+        chat_id = _default_group_cache["chat_id"]
+        if chat_id is None:
+            return None, None
+        if chat_id in _group_title_cache:
+            return chat_id, _group_title_cache[chat_id]
+
+    # Один запрос вместо двух: группа с is_default=1, иначе первая по chat_id
+    cur = conn.execute(
+        "SELECT chat_id, title FROM managed_groups ORDER BY is_default DESC, chat_id LIMIT 1"
+    )
+    row = cur.fetchone()
+    if not row:
+        _default_group_cache["chat_id"] = None
+        return None, None
+    chat_id, title = row
+    _default_group_cache["chat_id"] = chat_id
+    _group_title_cache[chat_id] = title
+    return chat_id, title
+
+
+@ttl_cache(seconds=300)
 def get_all_groups_with_bot():
-    cursor.execute(
+    cur = conn.execute(
         "SELECT chat_id, title, type FROM managed_groups ORDER BY added_date DESC"
     )
-    return cursor.fetchall()
+    return cur.fetchall()
+
+
+# Кэш активных способов оплаты: {"active": [rows]}
+_payment_methods_cache = {}
+
+
+def _invalidate_payment_methods():
+    """Сбрасывает кэш способов оплаты"""
+    _payment_methods_cache.clear()
 
 
 def get_active_payment_methods():
-    cursor.execute(
+    cached = _payment_methods_cache.get("active")
+    if cached is not None:
+        return cached
+
+    cur = conn.execute(
         "SELECT id, name, type, description, details FROM payment_methods WHERE is_active=1 ORDER BY id"
     )
-    return cursor.fetchall()
+    _payment_methods_cache["active"] = cur.fetchall()
+    return _payment_methods_cache["active"]
+
+
+def get_all_payment_methods():
+    """Все способы оплаты вместе с флагом is_active"""
+    cur = conn.execute(
+        "SELECT id, name, type, description, details, is_active FROM payment_methods ORDER BY id"
+    )
+    return cur.fetchall()
 
 
 def get_payment_method_by_id(method_id):
-    cursor.execute(
+    cur = conn.execute(
         "SELECT id, name, type, description, details FROM payment_methods WHERE id=?",
         (method_id,),
     )
-    return cursor.fetchone()
+    return cur.fetchone()
 
 
 def get_current_period():
@@ -471,24 +827,24 @@ def get_active_payment_type():
 def can_user_pay_partial(user_id, plan_id):
     """Проверяет, может ли пользователь оплатить вторую часть"""
     month, year = get_current_period()
-    cursor.execute(
+    cur = conn.execute(
         """
         SELECT id FROM subscriptions 
         WHERE user_id=? AND plan_id=? AND current_period_month=? AND current_period_year=? AND part_paid='first'
     """,
         (user_id, plan_id, month, year),
     )
-    return cursor.fetchone() is not None
+    return cur.fetchone() is not None
 
 
 def activate_subscription(
     user_id, plan_id, payment_type="full", group_id=None, is_renewal=False
 ):
     """Активирует или продлевает подписку для пользователя"""
-    cursor.execute(
+    cur = conn.execute(
         "SELECT price_cents, title, group_id FROM plans WHERE id=?", (plan_id,)
     )
-    plan = cursor.fetchone()
+    plan = cur.fetchone()
     if not plan:
         return False, "Тариф не найден"
 
@@ -512,7 +868,7 @@ def activate_subscription(
         logging.debug(f"⚠️ Не удалось разбанить пользователя {user_id}: {e}")
 
     # Проверяем существующую активную подписку
-    cursor.execute(
+    cur = conn.execute(
         """
         SELECT id, active, current_period_month, current_period_year, end_ts, part_paid
         FROM subscriptions 
@@ -522,7 +878,7 @@ def activate_subscription(
         (user_id, plan_id),
     )
 
-    existing_sub = cursor.fetchone()
+    existing_sub = cur.fetchone()
 
     # Расчет даты окончания - всегда до 5 числа следующего месяца
     # Определяем следующий месяц
@@ -559,7 +915,7 @@ def activate_subscription(
             and existing_end_ts > now_ts
         ):
             # Просто обновляем ссылку
-            cursor.execute(
+            conn.execute(
                 """
                 UPDATE subscriptions 
                 SET invite_link=?, last_notification_ts=NULL
@@ -568,10 +924,11 @@ def activate_subscription(
                 (invite_link, sub_id),
             )
             conn.commit()
+            _sub_cache.pop((user_id, plan_id), None)
             return True, invite_link
         else:
             # Обновляем существующую подписку на новый месяц
-            cursor.execute(
+            conn.execute(
                 """
                 UPDATE subscriptions 
                 SET current_period_month=?, current_period_year=?, part_paid=?, 
@@ -592,7 +949,7 @@ def activate_subscription(
             )
     else:
         # Создаем новую подписку
-        cursor.execute(
+        conn.execute(
             """
             INSERT INTO subscriptions (user_id, plan_id, start_ts, end_ts, invite_link, active, removed, group_id, 
                                      payment_type, current_period_month, current_period_year, part_paid, next_payment_date, last_notification_ts) 
@@ -614,6 +971,7 @@ def activate_subscription(
         )
 
     conn.commit()
+    _sub_cache.pop((user_id, plan_id), None)
     return True, invite_link
 
 
@@ -624,40 +982,46 @@ def callback_check_my_subscription(call):
     bot.answer_callback_query(call.id)
 
 
-def generate_promo_code(length=8):
-    """Генерирует уникальный промокод"""
+def generate_promo_code(length=8, batch=8):
+    """Генерирует уникальный промокод (пачка кандидатов проверяется одним запросом)"""
+    alphabet = string.ascii_uppercase + string.digits
     while True:
-        code = "".join(random.choices(string.ascii_uppercase + string.digits, k=length))
-        cursor.execute("SELECT id FROM promo_codes WHERE code=?", (code,))
-        if not cursor.fetchone():
-            return code
+        candidates = {"".join(random.choices(alphabet, k=length)) for _ in range(batch)}
+        placeholders = ",".join("?" * len(candidates))
+        cur = conn.execute(
+            f"SELECT code FROM promo_codes WHERE code IN ({placeholders})",
+            tuple(candidates),
+        )
+        free = candidates - {row[0] for row in cur.fetchall()}
+        if free:
+            return free.pop()
 
 
 def get_promo_code(code):
     """Получает информацию о промокоде"""
-    cursor.execute(
+    cur = conn.execute(
         """
         SELECT id, code, discount_percent, discount_fixed_cents, is_active, used_count, max_uses, expires_ts 
         FROM promo_codes WHERE code=?
     """,
         (code,),
     )
-    return cursor.fetchone()
+    return cur.fetchone()
 
 
 def can_use_promo_code(promo_id, user_id):
     """Проверяет может ли пользователь использовать промокод"""
-    cursor.execute(
+    cur = conn.execute(
         "SELECT id FROM promo_usage WHERE promo_id=? AND user_id=?", (promo_id, user_id)
     )
-    if cursor.fetchone():
+    if cur.fetchone():
         return False, "Вы уже использовали этот промокод"
 
-    cursor.execute(
+    cur = conn.execute(
         "SELECT is_active, max_uses, used_count, expires_ts FROM promo_codes WHERE id=?",
         (promo_id,),
     )
-    promo = cursor.fetchone()
+    promo = cur.fetchone()
     if not promo:
         return False, "Промокод не найден"
 
@@ -704,8 +1068,8 @@ def apply_promo_code(price_cents, promo_data):
 
 def get_payment_options(user_id, plan_id):
     """Возвращает доступные варианты оплаты для пользователя - только полная оплата"""
-    cursor.execute("SELECT price_cents FROM plans WHERE id=?", (plan_id,))
-    plan = cursor.fetchone()
+    cur = conn.execute("SELECT price_cents FROM plans WHERE id=?", (plan_id,))
+    plan = cur.fetchone()
     if not plan:
         return []
 
@@ -727,7 +1091,67 @@ def get_payment_options(user_id, plan_id):
 
 
 # admin ephemeral states
-admin_states = {}
+@dataclass(slots=True)
+class AdminState:
+    """Сессия админа: режим/шаг диалога и собранные на шагах данные"""
+
+    mode: str = ""
+    step: str = ""
+    chat_id: int = 0
+    # Предметы (категории)
+    category_id: int | None = None
+    source_category_id: int | None = None
+    name: str | None = None
+    new_name: str | None = None
+    current_name: str | None = None
+    # Создание группы обучения
+    title: str | None = None
+    price_cents: int | None = None
+    description: str | None = None
+    group_id: int | None = None
+    group_title: str | None = None
+    media_files: list = field(default_factory=list)
+    media_type: str | None = None
+    media_ack_timer: threading.Timer | None = None
+    # Редактирование группы обучения
+    plan_id: int | None = None
+    current_title: str | None = None
+    current_price: int | None = None
+    current_description: str | None = None
+    current_group_id: int | None = None
+    current_group_title: str | None = None
+    current_category_id: int | None = None
+    current_category_name: str | None = None
+    saved_media_key: tuple | None = None
+    pending_fields: dict = field(default_factory=dict)
+    # Способы оплаты и промокоды
+    method_id: int | None = None
+    promo_type: str | None = None
+    discount_percent: int | None = None
+    discount_fixed_cents: int | None = None
+    max_uses: int | None = None
+
+
+admin_states = {}  # uid -> AdminState
+
+
+def start_admin_session(uid, state):
+    """Начинает новую сессию админа; отложенные правки прежней записываются в базу"""
+    previous = admin_states.get(uid)
+    if previous is not None:
+        flush_pending_plan_fields(previous)
+    admin_states[uid] = state
+
+
+def _admin_state_is(uid, mode, step=None):
+    """Проверяет режим (и шаг, если задан) состояния админа одним поиском"""
+    state = admin_states.get(uid)
+    return (
+        state is not None
+        and state.mode == mode
+        and (step is None or state.step == step)
+    )
+
 
 # user ephemeral states для ручной оплаты и промокодов
 user_states = {}
@@ -751,44 +1175,19 @@ def process_updates(updates):
                             title,
                             chat.type if hasattr(chat, "type") else "group",
                         )
-                        for aid in ADMIN_IDS:
-                            try:
-                                bot.send_message(
-                                    aid,
-                                    f"✅ Бот получил права администратора в чате: {title} (ID: {chat_id})",
-                                )
-                            except:
-                                pass
+                        notify_admins(
+                            f"✅ Бот получил права администратора в чате: {title} (ID: {chat_id})"
+                        )
                     elif status in ("member",):
                         add_group_to_db(
                             chat_id,
                             title,
                             chat.type if hasattr(chat, "type") else "group",
                         )
-                        for aid in ADMIN_IDS:
-                            try:
-                                bot.send_message(
-                                    aid,
-                                    f"✅ Бот добавлен в чат: {title} (ID: {chat_id})",
-                                )
-                            except:
-                                pass
+                        notify_admins(f"✅ Бот добавлен в чат: {title} (ID: {chat_id})")
                     elif status in ("left", "kicked"):
-                        try:
-                            cursor.execute(
-                                "DELETE FROM managed_groups WHERE chat_id=?", (chat_id,)
-                            )
-                            conn.commit()
-                        except:
-                            pass
-                        for aid in ADMIN_IDS:
-                            try:
-                                bot.send_message(
-                                    aid,
-                                    f"❌ Бот удалён из чата: {title} (ID: {chat_id})",
-                                )
-                            except:
-                                pass
+                        remove_group_from_db(chat_id)
+                        notify_admins(f"❌ Бот удалён из чата: {title} (ID: {chat_id})")
         except Exception:
             logging.exception("Error in process_updates")
 
@@ -814,14 +1213,9 @@ def handle_my_chat_member(update):
 
         if new_status in ("administrator", "creator", "member"):
             add_group_to_db(chat_id, title, getattr(chat, "type", "group"))
-            for aid in ADMIN_IDS:
-                try:
-                    bot.send_message(
-                        aid,
-                        f"✅ Бот активирован/добавлен в чат: {title} (ID: {chat_id}). Статус: {new_status}",
-                    )
-                except:
-                    pass
+            notify_admins(
+                f"✅ Бот активирован/добавлен в чат: {title} (ID: {chat_id}). Статус: {new_status}"
+            )
             try:
                 if chat.type in ("group", "supergroup"):
                     bot.send_message(
@@ -832,18 +1226,8 @@ def handle_my_chat_member(update):
                 pass
 
         if new_status in ("left", "kicked"):
-            try:
-                cursor.execute("DELETE FROM managed_groups WHERE chat_id=?", (chat_id,))
-                conn.commit()
-            except:
-                pass
-            for aid in ADMIN_IDS:
-                try:
-                    bot.send_message(
-                        aid, f"❌ Бот удалён из чата: {title} (ID: {chat_id})"
-                    )
-                except:
-                    pass
+            remove_group_from_db(chat_id)
+            notify_admins(f"❌ Бот удалён из чата: {title} (ID: {chat_id})")
 
     except Exception:
         logging.exception("Error in handle_my_chat_member")
@@ -913,6 +1297,7 @@ def cmd_start(message):
 
 # All user-visible command handlers below will ignore non-private chats (so bot won't chat in groups)
 def only_private(fn):
+    @wraps(fn)
     def wrapper(message, *a, **k):
         if message.chat.type != "private":
             return
@@ -921,6 +1306,20 @@ def only_private(fn):
     return wrapper
 
 
+def admin_only(fn):
+    """Пропускает в обработчик только админов; на callback отвечает отказом"""
+
+    @wraps(fn)
+    def wrapper(update, *a, **k):
+        if update.from_user.id not in ADMIN_IDS:
+            if isinstance(update, types.CallbackQuery):
+                bot.answer_callback_query(update.id, "🚫 Доступ запрещен.")
+            return
+        return fn(update, *a, **k)
+
+    return wrapper
+
+
 @bot.message_handler(func=lambda message: message.text == "📋 Группы обучения")
 @only_private
 def show_plans(message):
@@ -943,10 +1342,10 @@ def show_plans(message):
     markup = types.InlineKeyboardMarkup()
     for cat_id, name, description in categories:
         # Получаем количество групп в категории
-        cursor.execute(
+        cur = conn.execute(
             "SELECT COUNT(*) FROM plans WHERE category_id=? AND is_active=1", (cat_id,)
         )
-        count = cursor.fetchone()[0]
+        count = cur.fetchone()[0]
 
         button_text = f"{name} ({count})"
         if description:
@@ -984,7 +1383,7 @@ def callback_user_select_category(call):
         category_name = category[1]
 
         # Получаем группы для этой категории
-        cursor.execute(
+        cur = conn.execute(
             """
             SELECT p.id, p.title, p.price_cents, p.duration_days, p.description, 
                    p.media_file_id, p.media_type, p.media_file_ids, p.group_id, mg.title as group_title
@@ -996,7 +1395,7 @@ def callback_user_select_category(call):
             (category_id,),
         )
 
-        rows = cursor.fetchall()
+        rows = cur.fetchall()
 
         if not rows:
             bot.answer_callback_query(
@@ -1225,11 +1624,11 @@ def callback_buy_for_existing(call):
             return
 
         # Получаем информацию о тарифе
-        cursor.execute(
+        cur = conn.execute(
             "SELECT title, price_cents, description, group_id FROM plans WHERE id=?",
             (plan_id,),
         )
-        plan = cursor.fetchone()
+        plan = cur.fetchone()
         if not plan:
             bot.answer_callback_query(call.id, "❌ Тариф не найден.")
             return
@@ -1315,7 +1714,7 @@ def callback_user_select_plan(call):
         existing_sub = check_existing_subscription(user.id, plan_id)
 
         # Получаем информацию о группе
-        cursor.execute(
+        cur = conn.execute(
             """
             SELECT p.id, p.title, p.price_cents, p.duration_days, p.description, 
                    p.media_file_id, p.media_type, p.media_file_ids, p.group_id, mg.title as group_title,
@@ -1328,7 +1727,7 @@ def callback_user_select_plan(call):
             (plan_id,),
         )
 
-        r = cursor.fetchone()
+        r = cur.fetchone()
         if not r:
             bot.answer_callback_query(call.id, "❌ Группа не найдена.")
             return
@@ -1555,11 +1954,11 @@ def callback_new_link(call):
         sub_id = int(parts[1])
 
         # Получаем подписку
-        cursor.execute(
+        cur = conn.execute(
             "SELECT user_id, plan_id, group_id, invite_link FROM subscriptions WHERE id=?",
             (sub_id,),
         )
-        row = cursor.fetchone()
+        row = cur.fetchone()
         if not row:
             bot.answer_callback_query(call.id, "❌ Подписка не найдена.")
             return
@@ -1612,7 +2011,7 @@ def callback_new_link(call):
 
         # Сохраняем новую ссылку в БД
         try:
-            cursor.execute(
+            conn.execute(
                 "UPDATE subscriptions SET invite_link=?, last_notification_ts=? WHERE id=?",
                 (invite, int(time.time()), sub_id),
             )
@@ -1660,11 +2059,11 @@ def callback_buy_full(call):
         user = call.from_user
         plan_id = int(call.data.split(":")[1])
 
-        cursor.execute(
+        cur = conn.execute(
             "SELECT title, price_cents, description, group_id FROM plans WHERE id=?",
             (plan_id,),
         )
-        plan = cursor.fetchone()
+        plan = cur.fetchone()
         if not plan:
             bot.answer_callback_query(call.id, "❌ Группа не найдена.")
             return
@@ -1817,11 +2216,11 @@ def callback_renew_plan(call):
             return
 
         # Получаем информацию о тарифе
-        cursor.execute(
+        cur = conn.execute(
             "SELECT title, price_cents, description, group_id FROM plans WHERE id=?",
             (plan_id,),
         )
-        plan = cursor.fetchone()
+        plan = cur.fetchone()
         if not plan:
             bot.answer_callback_query(call.id, "❌ Тариф не найден.")
             return
@@ -2067,11 +2466,11 @@ def callback_buy_with_promo(call):
         user = call.from_user
         pid = int(call.data.split(":")[1])
 
-        cursor.execute(
+        cur = conn.execute(
             "SELECT title, price_cents, description, group_id FROM plans WHERE id=?",
             (pid,),
         )
-        plan = cursor.fetchone()
+        plan = cur.fetchone()
         if not plan:
             bot.answer_callback_query(call.id, "❌ Группа не найдена.")
             return
@@ -2337,8 +2736,8 @@ def is_valid_file_id(file_id):
 @only_private
 def show_balance(message):
     uid = message.from_user.id
-    cursor.execute("SELECT cashback_cents FROM users WHERE user_id=?", (uid,))
-    r = cursor.fetchone()
+    cur = conn.execute("SELECT cashback_cents FROM users WHERE user_id=?", (uid,))
+    r = cur.fetchone()
     bal = r[0] if r else 0
     bot.send_message(
         message.chat.id, f"💰 Ваш баланс кэшбэка: {price_str_from_cents(bal)}"
@@ -2362,7 +2761,7 @@ def show_ref(message):
 def show_my_subscription(message):
     """Показывает подписки пользователя с кнопкой продления"""
     uid = message.from_user.id
-    cursor.execute(
+    cur = conn.execute(
         """
         SELECT s.id, s.plan_id, s.start_ts, s.end_ts, s.active, s.invite_link, 
                p.title, s.payment_type, s.part_paid, s.current_period_month, 
@@ -2374,7 +2773,7 @@ def show_my_subscription(message):
     """,
         (uid,),
     )
-    rows = cursor.fetchall()
+    rows = cur.fetchall()
 
     if not rows:
         bot.send_message(uid, "📭 У вас нет активных подписок.")
@@ -2452,11 +2851,11 @@ def callback_select_plan(call):
     try:
         user = call.from_user
         pid = int(call.data.split(":")[1])
-        cursor.execute(
+        cur = conn.execute(
             "SELECT title, price_cents, description, group_id FROM plans WHERE id=?",
             (pid,),
         )
-        plan = cursor.fetchone()
+        plan = cur.fetchone()
         if not plan:
             bot.answer_callback_query(call.id, "❌ Группа не найдена.")
             return
@@ -2532,11 +2931,11 @@ def callback_buy_handler(call):
         payment_type = parts[1].split(":")[0]
         pid = int(parts[1].split(":")[1])
 
-        cursor.execute(
+        cur = conn.execute(
             "SELECT title, price_cents, description, group_id FROM plans WHERE id=?",
             (pid,),
         )
-        plan = cursor.fetchone()
+        plan = cur.fetchone()
         if not plan:
             bot.answer_callback_query(call.id, "❌ Группа не найдена.")
             return
@@ -2826,18 +3225,19 @@ def process_card_payment(
     mode = state.get("mode", "new_subscription")
 
     current_month, current_year = get_current_period()
+    now_ts = int(time.time())
 
     # Создаем payload с информацией о режиме
-    payload = f"plan:{pid}:user:{user.id}:type:{payment_type}:month:{current_month}:year:{current_year}:promo:{promo_id or 0}:mode:{mode}:{int(time.time())}"
+    payload = f"plan:{pid}:user:{user.id}:type:{payment_type}:month:{current_month}:year:{current_year}:promo:{promo_id or 0}:mode:{mode}:{now_ts}"
 
-    cursor.execute(
+    conn.execute(
         "INSERT OR REPLACE INTO invoices (payload, user_id, plan_id, amount_cents, created_ts, payment_type, period_month, period_year, promo_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
         (
             payload,
             user.id,
             pid,
             price_cents,
-            int(time.time()),
+            now_ts,
             payment_type,
             current_month,
             current_year,
@@ -3010,11 +3410,11 @@ def callback_paymethod(call):
         state = user_states[user.id]
 
         # Получаем информацию о тарифе
-        cursor.execute(
+        cur = conn.execute(
             "SELECT title, price_cents, description, group_id FROM plans WHERE id=?",
             (pid,),
         )
-        plan = cursor.fetchone()
+        plan = cur.fetchone()
         if not plan:
             bot.answer_callback_query(call.id, "❌ Тариф не найден.")
             return
@@ -3245,7 +3645,7 @@ def handle_full_name(message):
         return
 
     # Сохраняем заявку на ручную оплату
-    cursor.execute(
+    cur = conn.execute(
         """
         INSERT INTO manual_payments (user_id, plan_id, amount_cents, receipt_photo, full_name, created_ts, payment_type, period_month, period_year, promo_id)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
@@ -3262,12 +3662,12 @@ def handle_full_name(message):
             state.get("promo_id"),
         ),
     )
-    payment_id = cursor.lastrowid
+    payment_id = cur.lastrowid
     conn.commit()
 
     # Уведомляем админов
-    cursor.execute("SELECT title FROM plans WHERE id=?", (state["plan_id"],))
-    plan_title = cursor.fetchone()[0]
+    cur = conn.execute("SELECT title FROM plans WHERE id=?", (state["plan_id"],))
+    plan_title = cur.fetchone()[0]
 
     payment_type_text = get_payment_type_text(state["payment_type"])
 
@@ -3341,8 +3741,8 @@ def got_payment(message):
         bot.send_message(user_id, f"❌ Ошибка активации подписки: {result}")
         return
 
-    cursor.execute("SELECT title FROM plans WHERE id=?", (plan_id,))
-    plan_title = cursor.fetchone()[0]
+    cur = conn.execute("SELECT title FROM plans WHERE id=?", (plan_id,))
+    plan_title = cur.fetchone()[0]
 
     # Определяем текст сообщения в зависимости от режима
     if mode == "renewal":
@@ -3364,24 +3764,25 @@ def got_payment(message):
 
     # Если был применен промокод, отмечаем его использование
     if promo_id and promo_id > 0:
-        cursor.execute(
-            "INSERT INTO promo_usage (promo_id, user_id, used_ts) VALUES (?, ?, ?)",
-            (promo_id, user_id, int(time.time())),
-        )
-        cursor.execute(
-            "UPDATE promo_codes SET used_count = used_count + 1 WHERE id=?", (promo_id,)
-        )
-        conn.commit()
+        with conn:
+            conn.execute(
+                "INSERT INTO promo_usage (promo_id, user_id, used_ts) VALUES (?, ?, ?)",
+                (promo_id, user_id, int(time.time())),
+            )
+            conn.execute(
+                "UPDATE promo_codes SET used_count = used_count + 1 WHERE id=?",
+                (promo_id,),
+            )
 
     # cashback для реферера
-    cursor.execute("SELECT referred_by FROM users WHERE user_id=?", (user_id,))
-    urow = cursor.fetchone()
+    cur = conn.execute("SELECT referred_by FROM users WHERE user_id=?", (user_id,))
+    urow = cur.fetchone()
     referred_by = urow[0] if urow else None
 
     if referred_by:
         amount_cents = sp.total_amount
         cashback = int(math.floor(amount_cents * REFERRAL_PERCENT / 100.0))
-        cursor.execute(
+        conn.execute(
             "UPDATE users SET cashback_cents = cashback_cents + ? WHERE user_id=?",
             (cashback, referred_by),
         )
@@ -3400,45 +3801,56 @@ def got_payment(message):
         user_states.pop(user_id)
 
 
+def invalidate_category_cache():
+    """Сбрасывает кэш категорий после любых изменений в таблице categories"""
+    get_all_categories.cache_clear()
+    get_category_by_id.cache_clear()
+
+
+@ttl_cache(seconds=300)
 def get_all_categories():
     """Получает все активные категории"""
-    cursor.execute(
+    cur = conn.execute(
         "SELECT id, name, description FROM categories WHERE is_active=1 ORDER BY name"
     )
-    return cursor.fetchall()
+    return cur.fetchall()
 
 
+@ttl_cache(seconds=300)
 def get_category_by_id(category_id):
     """Получает категорию по ID"""
-    cursor.execute(
+    cur = conn.execute(
         "SELECT id, name, description FROM categories WHERE id=?", (category_id,)
     )
-    return cursor.fetchone()
+    return cur.fetchone()
 
 
 def create_category(name, description=""):
     """Создает новую категорию"""
-    cursor.execute(
+    cur = conn.execute(
         "INSERT INTO categories (name, description, created_ts) VALUES (?, ?, ?)",
         (name, description, int(time.time())),
     )
     conn.commit()
-    return cursor.lastrowid
+    invalidate_category_cache()
+    return cur.lastrowid
 
 
 def update_category(category_id, name, description):
     """Обновляет категорию"""
-    cursor.execute(
+    conn.execute(
         "UPDATE categories SET name=?, description=? WHERE id=?",
         (name, description, category_id),
     )
     conn.commit()
+    invalidate_category_cache()
 
 
 def delete_category(category_id):
     """Удаляет категорию (мягкое удаление)"""
-    cursor.execute("UPDATE categories SET is_active=0 WHERE id=?", (category_id,))
+    conn.execute("UPDATE categories SET is_active=0 WHERE id=?", (category_id,))
     conn.commit()
+    invalidate_category_cache()
 
 
 # ----------------- Админ-панель -----------------
@@ -3477,11 +3889,8 @@ def admin_menu(message):
 
 
 @bot.callback_query_handler(func=lambda call: call.data == "edit_category_list")
+@admin_only
 def callback_edit_category_list(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     categories = get_all_categories()
     if not categories:
         bot.answer_callback_query(call.id, "📭 Нет предметов для редактирования.")
@@ -3509,11 +3918,8 @@ def callback_edit_category_list(call):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("edit_category:")
 )
+@admin_only
 def callback_edit_category(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     category_id = int(call.data.split(":")[1])
 
     category = get_category_by_id(category_id)
@@ -3523,14 +3929,17 @@ def callback_edit_category(call):
 
     cat_id, name, description = category
 
-    admin_states[call.from_user.id] = {
-        "mode": "edit_category",
-        "category_id": category_id,
-        "step": "name",
-        "current_name": name,
-        "current_description": description,
-        "chat_id": call.message.chat.id,
-    }
+    start_admin_session(
+        call.from_user.id,
+        AdminState(
+            mode="edit_category",
+            category_id=category_id,
+            step="name",
+            current_name=name,
+            current_description=description,
+            chat_id=call.message.chat.id,
+        ),
+    )
 
     bot.answer_callback_query(call.id, f"Редактирование: {name}")
     bot.send_message(
@@ -3541,11 +3950,8 @@ def callback_edit_category(call):
 
 
 @bot.callback_query_handler(func=lambda call: call.data == "delete_category_list")
+@admin_only
 def callback_delete_category_list(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     categories = get_all_categories()
     if not categories:
         bot.answer_callback_query(call.id, "📭 Нет предметов для удаления.")
@@ -3568,14 +3974,25 @@ def callback_delete_category_list(call):
     )
 
 
+# Шаблоны сообщений при удалении предмета
+TPL_CAT_DELETE_WARN = (
+    "⚠️ <b>Внимание!</b>\n\n"
+    "В предмете '{name}' есть {n} активных групп.\n\n"
+    "Выберите действие:"
+)
+TPL_CAT_DELETE_CONFIRM = (
+    "🗑️ <b>Подтвердите удаление предмета</b>\n\n"
+    "Предмет: {name}\n"
+    "Описание: {description}\n\n"
+    "Вы уверены, что хотите удалить этот предмет?"
+)
+
+
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("delete_category:")
 )
+@admin_only
 def callback_delete_category(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     category_id = int(call.data.split(":")[1])
 
     category = get_category_by_id(category_id)
@@ -3586,10 +4003,10 @@ def callback_delete_category(call):
     cat_id, name, description = category
 
     # Проверяем, есть ли группы в этой категории
-    cursor.execute(
+    cur = conn.execute(
         "SELECT COUNT(*) FROM plans WHERE category_id=? AND is_active=1", (category_id,)
     )
-    groups_count = cursor.fetchone()[0]
+    groups_count = cur.fetchone()[0]
 
     if groups_count > 0:
         markup = types.InlineKeyboardMarkup()
@@ -3612,9 +4029,7 @@ def callback_delete_category(call):
         bot.answer_callback_query(call.id, "⚠️ В категории есть группы")
         bot.send_message(
             call.message.chat.id,
-            f"⚠️ <b>Внимание!</b>\n\n"
-            f"В предмете '{name}' есть {groups_count} активных групп.\n\n"
-            f"Выберите действие:",
+            TPL_CAT_DELETE_WARN.format_map({"name": name, "n": groups_count}),
             parse_mode="HTML",
             reply_markup=markup,
         )
@@ -3632,10 +4047,9 @@ def callback_delete_category(call):
     bot.answer_callback_query(call.id, "Подтвердите удаление")
     bot.send_message(
         call.message.chat.id,
-        f"🗑️ <b>Подтвердите удаление предмета</b>\n\n"
-        f"Предмет: {name}\n"
-        f"Описание: {description or 'нет'}\n\n"
-        f"Вы уверены, что хотите удалить этот предмет?",
+        TPL_CAT_DELETE_CONFIRM.format_map(
+            {"name": name, "description": description or "нет"}
+        ),
         parse_mode="HTML",
         reply_markup=markup,
     )
@@ -3644,11 +4058,8 @@ def callback_delete_category(call):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("confirm_delete_category:")
 )
+@admin_only
 def callback_confirm_delete_category(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     category_id = int(call.data.split(":")[1])
 
     category = get_category_by_id(category_id)
@@ -3669,26 +4080,28 @@ def callback_confirm_delete_category(call):
     func=lambda call: call.data
     and call.data.startswith("confirm_delete_category_with_groups:")
 )
+@admin_only
 def callback_confirm_delete_category_with_groups(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
+    # Сразу отвечаем на callback, чтобы убрать "часики" у кнопки
+    bot.answer_callback_query(call.id, "⏳ Удаляем предмет и группы...")
 
     category_id = int(call.data.split(":")[1])
 
     category = get_category_by_id(category_id)
     if not category:
-        bot.answer_callback_query(call.id, "❌ Предмет не найден.")
+        bot.send_message(call.message.chat.id, "❌ Предмет не найден.")
         return
 
     cat_id, name, description = category
 
-    # Удаляем категорию и деактивируем все группы в ней
-    cursor.execute("UPDATE plans SET is_active=0 WHERE category_id=?", (category_id,))
-    delete_category(category_id)
-    conn.commit()
+    # Удаляем категорию и деактивируем все группы в ней одной транзакцией
+    with conn:
+        conn.execute(
+            "UPDATE plans SET is_active=0 WHERE category_id=?", (category_id,)
+        )
+        conn.execute("UPDATE categories SET is_active=0 WHERE id=?", (category_id,))
+    invalidate_category_cache()
 
-    bot.answer_callback_query(call.id, f"✅ Предмет и группы удалены")
     bot.send_message(
         call.message.chat.id,
         f"✅ Предмет '{name}' и все связанные группы успешно удалены.",
@@ -3698,38 +4111,40 @@ def callback_confirm_delete_category_with_groups(call):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("transfer_category_groups:")
 )
+@admin_only
 def callback_transfer_category_groups(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
+    # Сразу отвечаем на callback, клавиатуру строим уже после ответа
+    bot.answer_callback_query(call.id, "Выберите целевой предмет")
 
     category_id = int(call.data.split(":")[1])
 
     category = get_category_by_id(category_id)
     if not category:
-        bot.answer_callback_query(call.id, "❌ Предмет не найден.")
+        bot.send_message(call.message.chat.id, "❌ Предмет не найден.")
         return
 
     # Получаем все категории кроме текущей
-    cursor.execute(
+    cur = conn.execute(
         "SELECT id, name, description FROM categories WHERE id != ? AND is_active=1",
         (category_id,),
     )
-    other_categories = cursor.fetchall()
+    other_categories = cur.fetchall()
 
     if not other_categories:
-        bot.answer_callback_query(call.id, "❌ Нет других предметов для переноса")
         bot.send_message(
             call.message.chat.id, "❌ Нет других предметов для переноса групп."
         )
         return
 
-    admin_states[call.from_user.id] = {
-        "mode": "transfer_category",
-        "source_category_id": category_id,
-        "step": "select_target",
-        "chat_id": call.message.chat.id,
-    }
+    start_admin_session(
+        call.from_user.id,
+        AdminState(
+            mode="transfer_category",
+            source_category_id=category_id,
+            step="select_target",
+            chat_id=call.message.chat.id,
+        ),
+    )
 
     markup = types.InlineKeyboardMarkup()
     for cat_id, name, description in other_categories:
@@ -3743,7 +4158,6 @@ def callback_transfer_category_groups(call):
             )
         )
 
-    bot.answer_callback_query(call.id, "Выберите целевой предмет")
     bot.send_message(
         call.message.chat.id,
         f"🔄 <b>Перенос групп</b>\n\n"
@@ -3756,23 +4170,24 @@ def callback_transfer_category_groups(call):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("select_target_category:")
 )
+@admin_only
 def callback_select_target_category(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
+    bot.answer_callback_query(call.id, "⏳ Переносим группы...")
 
     parts = call.data.split(":")
     target_category_id = int(parts[1])
     source_category_id = int(parts[2])
 
-    # Переносим группы
-    cursor.execute(
-        "UPDATE plans SET category_id=? WHERE category_id=?",
-        (target_category_id, source_category_id),
-    )
-    # Удаляем исходную категорию
-    delete_category(source_category_id)
-    conn.commit()
+    # Переносим группы и удаляем исходную категорию одной транзакцией
+    with conn:
+        conn.execute(
+            "UPDATE plans SET category_id=? WHERE category_id=?",
+            (target_category_id, source_category_id),
+        )
+        conn.execute(
+            "UPDATE categories SET is_active=0 WHERE id=?", (source_category_id,)
+        )
+    invalidate_category_cache()
 
     # Получаем названия категорий для сообщения
     source_category = get_category_by_id(source_category_id)
@@ -3781,7 +4196,6 @@ def callback_select_target_category(call):
     source_name = source_category[1] if source_category else "Неизвестно"
     target_name = target_category[1] if target_category else "Неизвестно"
 
-    bot.answer_callback_query(call.id, "✅ Группы перенесены")
     bot.send_message(
         call.message.chat.id,
         f"✅ Группы из предмета '{source_name}' успешно перенесены в предмет '{target_name}'.",
@@ -3797,16 +4211,14 @@ def callback_cancel_delete_category(call):
 # Обработчики ввода текста для редактирования категорий
 @bot.message_handler(
     func=lambda m: m.from_user
-    and m.from_user.id in admin_states
-    and admin_states.get(m.from_user.id, {}).get("mode") == "edit_category"
-    and admin_states.get(m.from_user.id, {}).get("step") == "name"
+    and _admin_state_is(m.from_user.id, "edit_category", "name")
     and m.chat.type == "private"
 )
 def handle_edit_category_name(message):
     uid = message.from_user.id
     state = admin_states.get(uid)
 
-    if not state or state.get("chat_id") != message.chat.id:
+    if not state or state.chat_id != message.chat.id:
         return
 
     if not message.text:
@@ -3814,34 +4226,32 @@ def handle_edit_category_name(message):
         return
 
     new_name = message.text.strip()
-    state["new_name"] = new_name
-    state["step"] = "description"
+    state.new_name = new_name
+    state.step = "description"
 
     bot.send_message(
         message.chat.id,
         f"✏️ Новое название: {new_name}\n\n"
-        f"Введите новое описание (текущее: {state['current_description'] or 'нет'}):",
+        f"Введите новое описание (текущее: {state.current_description or 'нет'}):",
     )
 
 
 @bot.message_handler(
     func=lambda m: m.from_user
-    and m.from_user.id in admin_states
-    and admin_states.get(m.from_user.id, {}).get("mode") == "edit_category"
-    and admin_states.get(m.from_user.id, {}).get("step") == "description"
+    and _admin_state_is(m.from_user.id, "edit_category", "description")
     and m.chat.type == "private"
 )
 def handle_edit_category_description(message):
     uid = message.from_user.id
     state = admin_states.get(uid)
 
-    if not state or state.get("chat_id") != message.chat.id:
+    if not state or state.chat_id != message.chat.id:
         return
 
     new_description = message.text.strip()
 
     # Обновляем категорию в базе
-    update_category(state["category_id"], state["new_name"], new_description)
+    update_category(state.category_id, state.new_name, new_description)
 
     # Очищаем состояние
     admin_states.pop(uid, None)
@@ -3849,7 +4259,7 @@ def handle_edit_category_description(message):
     bot.send_message(
         message.chat.id,
         f"✅ Предмет успешно обновлен!\n\n"
-        f"🏷️ Название: {state['new_name']}\n"
+        f"🏷️ Название: {state.new_name}\n"
         f"📝 Описание: {new_description or 'нет'}",
         reply_markup=main_menu(uid),
     )
@@ -3857,10 +4267,8 @@ def handle_edit_category_description(message):
 
 @bot.message_handler(func=lambda message: message.text == "📚 Управление предметами")
 @only_private
+@admin_only
 def manage_categories(message):
-    if message.from_user.id not in ADMIN_IDS:
-        return
-
     categories = get_all_categories()
 
     text = "📚 <b>Управление предметами</b>\n\n"
@@ -3894,16 +4302,16 @@ def manage_categories(message):
 
 
 @bot.callback_query_handler(func=lambda call: call.data == "add_category")
+@admin_only
 def callback_add_category(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
-    admin_states[call.from_user.id] = {
-        "mode": "create_category",
-        "step": "name",
-        "chat_id": call.message.chat.id,
-    }
+    start_admin_session(
+        call.from_user.id,
+        AdminState(
+            mode="create_category",
+            step="name",
+            chat_id=call.message.chat.id,
+        ),
+    )
 
     bot.answer_callback_query(call.id, "Создание нового предмета...")
     bot.send_message(
@@ -3914,24 +4322,22 @@ def callback_add_category(call):
 
 @bot.message_handler(
     func=lambda m: m.from_user
-    and m.from_user.id in admin_states
-    and admin_states.get(m.from_user.id, {}).get("mode") == "create_category"
-    and admin_states.get(m.from_user.id, {}).get("step") == "name"
+    and _admin_state_is(m.from_user.id, "create_category", "name")
     and m.chat.type == "private"
 )
 def handle_category_name(message):
     uid = message.from_user.id
     state = admin_states.get(uid)
 
-    if not state or state.get("chat_id") != message.chat.id:
+    if not state or state.chat_id != message.chat.id:
         return
 
     if not message.text:
         bot.send_message(message.chat.id, "❌ Отправьте название текстом.")
         return
 
-    state["name"] = message.text.strip()
-    state["step"] = "description"
+    state.name = message.text.strip()
+    state.step = "description"
 
     bot.send_message(
         message.chat.id,
@@ -3941,16 +4347,14 @@ def handle_category_name(message):
 
 @bot.message_handler(
     func=lambda m: m.from_user
-    and m.from_user.id in admin_states
-    and admin_states.get(m.from_user.id, {}).get("mode") == "create_category"
-    and admin_states.get(m.from_user.id, {}).get("step") == "description"
+    and _admin_state_is(m.from_user.id, "create_category", "description")
     and m.chat.type == "private"
 )
 def handle_category_description(message):
     uid = message.from_user.id
     state = admin_states.get(uid)
 
-    if not state or state.get("chat_id") != message.chat.id:
+    if not state or state.chat_id != message.chat.id:
         return
 
     description = message.text.strip()
@@ -3958,13 +4362,13 @@ def handle_category_description(message):
         description = ""
 
     # Создаем категорию
-    category_id = create_category(state["name"], description)
+    category_id = create_category(state.name, description)
 
     admin_states.pop(uid, None)
 
     bot.send_message(
         message.chat.id,
-        f"✅ Предмет '{state['name']}' успешно создан!\nID: {category_id}",
+        f"✅ Предмет '{state.name}' успешно создан!\nID: {category_id}",
         reply_markup=main_menu(uid),
     )
 
@@ -3982,9 +4386,8 @@ def back_to_main(message):
 # Создание новой группы
 @bot.message_handler(func=lambda message: message.text == "➕ Новая группа")
 @only_private
+@admin_only
 def cmd_newplan(message):
-    if message.from_user.id not in ADMIN_IDS:
-        return
     uid = message.from_user.id
 
     # Проверяем есть ли категории
@@ -3996,13 +4399,14 @@ def cmd_newplan(message):
         )
         return
 
-    admin_states[uid] = {
-        "mode": "create",
-        "step": "category",
-        "media_files": [],
-        "media_type": None,
-        "chat_id": message.chat.id,
-    }
+    start_admin_session(
+        uid,
+        AdminState(
+            mode="create",
+            step="category",
+            chat_id=message.chat.id,
+        ),
+    )
 
     # Показываем выбор категории
     markup = types.InlineKeyboardMarkup()
@@ -4026,29 +4430,26 @@ def cmd_newplan(message):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("select_category:")
 )
+@admin_only
 def callback_admin_select_category(call):
     """Обработчик выбора категории в админ-панели"""
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     category_id = int(call.data.split(":")[1])
     uid = call.from_user.id
     state = admin_states.get(uid)
 
-    if not state or state.get("mode") != "create" or state.get("step") != "category":
+    if not state or state.mode != "create" or state.step != "category":
         bot.answer_callback_query(call.id, "❌ Сессия устарела.")
         return
 
-    state["category_id"] = category_id
-    state["step"] = "title"
+    state.category_id = category_id
+    state.step = "title"
+
+    bot.answer_callback_query(call.id, "✅ Предмет выбран")
 
     # Получаем название категории для информации
     category = get_category_by_id(category_id)
     category_name = category[1] if category else "Неизвестно"
 
-    bot.answer_callback_query(call.id, f"✅ Выбран предмет: {category_name}")
-
     # Обновляем сообщение или отправляем новое
     try:
         bot.edit_message_text(
@@ -4073,28 +4474,26 @@ def callback_admin_select_category(call):
 # Обработчик ввода названия группы
 @bot.message_handler(
     func=lambda m: m.from_user
-    and m.from_user.id in admin_states
-    and admin_states.get(m.from_user.id, {}).get("mode") == "create"
-    and admin_states.get(m.from_user.id, {}).get("step") == "title"
+    and _admin_state_is(m.from_user.id, "create", "title")
     and m.chat.type == "private"
 )
 def handle_plan_title(message):
     uid = message.from_user.id
     state = admin_states.get(uid)
 
-    if not state or state.get("chat_id") != message.chat.id:
+    if not state or state.chat_id != message.chat.id:
         return
 
     if not message.text:
         bot.send_message(message.chat.id, "❌ Отправьте название текстом.")
         return
 
-    state["title"] = message.text.strip()
-    state["step"] = "price"
+    state.title = message.text.strip()
+    state.step = "price"
 
     bot.send_message(
         message.chat.id,
-        f"✅ Название: {state['title']}\n\n"
+        f"✅ Название: {state.title}\n\n"
         f"Шаг 3/7: Введите цену в месяц (например: 14.99):",
     )
 
@@ -4102,16 +4501,14 @@ def handle_plan_title(message):
 # Обработчик ввода цены
 @bot.message_handler(
     func=lambda m: m.from_user
-    and m.from_user.id in admin_states
-    and admin_states.get(m.from_user.id, {}).get("mode") == "create"
-    and admin_states.get(m.from_user.id, {}).get("step") == "price"
+    and _admin_state_is(m.from_user.id, "create", "price")
     and m.chat.type == "private"
 )
 def handle_plan_price(message):
     uid = message.from_user.id
     state = admin_states.get(uid)
 
-    if not state or state.get("chat_id") != message.chat.id:
+    if not state or state.chat_id != message.chat.id:
         return
 
     cents = cents_from_str(message.text)
@@ -4119,8 +4516,8 @@ def handle_plan_price(message):
         bot.send_message(message.chat.id, "❌ Неправильный формат цены. Пример: 14.99")
         return
 
-    state["price_cents"] = cents
-    state["step"] = "description"
+    state.price_cents = cents
+    state.step = "description"
 
     bot.send_message(
         message.chat.id,
@@ -4132,32 +4529,26 @@ def handle_plan_price(message):
 # Обработчик ввода описания
 @bot.message_handler(
     func=lambda m: m.from_user
-    and m.from_user.id in admin_states
-    and admin_states.get(m.from_user.id, {}).get("mode") == "create"
-    and admin_states.get(m.from_user.id, {}).get("step") == "description"
+    and _admin_state_is(m.from_user.id, "create", "description")
     and m.chat.type == "private"
 )
 def handle_plan_description(message):
     uid = message.from_user.id
     state = admin_states.get(uid)
 
-    if not state or state.get("chat_id") != message.chat.id:
+    if not state or state.chat_id != message.chat.id:
         return
 
-    state["description"] = message.text.strip()
-    state["step"] = "group"
+    state.description = message.text.strip()
+    state.step = "group"
 
     # Показываем выбор группы
     groups = get_all_groups_with_bot()
     markup = types.InlineKeyboardMarkup()
 
     # Добавляем кнопку для группы по умолчанию
-    default_group_id = get_default_group()
+    default_group_id, default_title = get_default_group_with_title()
     if default_group_id:
-        cursor.execute(
-            "SELECT title FROM managed_groups WHERE chat_id=?", (default_group_id,)
-        )
-        default_title = cursor.fetchone()[0]
         markup.add(
             types.InlineKeyboardButton(
                 f"🏠 По умолчанию: {default_title}",
@@ -4177,18 +4568,81 @@ def handle_plan_description(message):
 
     bot.send_message(
         message.chat.id,
-        f"✅ Описание: {state['description']}\n\n"
+        f"✅ Описание: {state.description}\n\n"
         f"Шаг 5/7: Выберите группу/канал для подписки:",
         reply_markup=markup,
     )
 
 
+# Пауза после последнего файла, после которой подтверждаем всю пачку медиа
+MEDIA_ACK_DELAY = 0.5
+
+
+# Файлы альбома обрабатываются в разных потоках - замену таймера делаем под локом
+_media_ack_lock = threading.Lock()
+
+
+def _schedule_media_ack(chat_id, state):
+    """Откладывает подтверждение добавленных медиа: на альбом уходит одно сообщение"""
+    timer = threading.Timer(MEDIA_ACK_DELAY, _flush_media_ack, args=(chat_id, state))
+    timer.daemon = True
+    with _media_ack_lock:
+        if state.media_ack_timer:
+            state.media_ack_timer.cancel()
+        state.media_ack_timer = timer
+        timer.start()
+
+
+def _cancel_media_ack(state):
+    with _media_ack_lock:
+        timer, state.media_ack_timer = state.media_ack_timer, None
+    if timer:
+        timer.cancel()
+
+
+def _flush_media_ack(chat_id, state):
+    with _media_ack_lock:
+        # Уже заменённый таймер молчит - подтверждение отправит последний
+        if state.media_ack_timer is not threading.current_thread():
+            return
+        state.media_ack_timer = None
+    _safe_send(chat_id, f"✅ Медиа добавлены! Всего: {len(state.media_files)}")
+
+
+def _start_media_upload(state):
+    """Переводит state.media_files в deque пар (message_id, file_id) на шаге загрузки"""
+    # Части альбома обрабатываются в разных потоках и добавляются в любом
+    # порядке; порядок отправки восстанавливаем по message_id (см.
+    # _uploaded_media). Уже сохраненные медиа идут первыми
+    state.media_files = deque((0, file_id) for file_id in state.media_files)
+
+
+def _uploaded_media(state):
+    """Возвращает список file_id в порядке отправки (вне шага загрузки - как есть)"""
+    if not isinstance(state.media_files, deque):
+        return list(state.media_files)
+    return [file_id for _, file_id in sorted(state.media_files, key=lambda m: m[0])]
+
+
+def _append_media(state, message):
+    """Добавляет фото/видео из сообщения в state; возвращает число медиа или None"""
+    if message.photo:
+        file_id = message.photo[-1].file_id
+        media_type = "photo"
+    elif message.video:
+        file_id = message.video.file_id
+        media_type = "video"
+    else:
+        return None
+    state.media_files.append((message.message_id, file_id))
+    state.media_type = media_type
+    return len(state.media_files)
+
+
 # Обработчик медиа при создании
 @bot.message_handler(
     func=lambda m: m.from_user
-    and m.from_user.id in admin_states
-    and admin_states.get(m.from_user.id, {}).get("mode") == "create"
-    and admin_states.get(m.from_user.id, {}).get("step") == "media"
+    and _admin_state_is(m.from_user.id, "create", "media")
     and m.chat.type == "private",
     content_types=["text", "photo", "video"],
 )
@@ -4196,31 +4650,20 @@ def handle_plan_media(message):
     uid = message.from_user.id
     state = admin_states.get(uid)
 
-    if not state or state.get("chat_id") != message.chat.id:
-        return
-
-    if message.photo:
-        file_id = message.photo[-1].file_id
-        state.setdefault("media_files", []).append(file_id)
-        state["media_type"] = "photo"
-        bot.send_message(
-            message.chat.id, f"✅ Фото добавлено! Всего: {len(state['media_files'])}"
-        )
+    if not state or state.chat_id != message.chat.id:
         return
 
-    if message.video:
-        file_id = message.video.file_id
-        state.setdefault("media_files", []).append(file_id)
-        state["media_type"] = "video"
-        bot.send_message(
-            message.chat.id, f"✅ Видео добавлено! Всего: {len(state['media_files'])}"
-        )
+    if _append_media(state, message):
+        _schedule_media_ack(message.chat.id, state)
         return
 
     if message.text:
+        # Кнопки шага сами сообщают итог, отложенное подтверждение не нужно
+        _cancel_media_ack(state)
         txt = message.text.strip()
         if txt == "⏩ Пропустить медиа":
-            state["step"] = "finish"
+            state.step = "finish"
+            state.media_files = _uploaded_media(state)
             bot.send_message(
                 message.chat.id,
                 "✅ Медиа пропущены.",
@@ -4230,9 +4673,9 @@ def handle_plan_media(message):
             return
 
         if txt == "✅ Завершить добавление медиа":
-            state["step"] = "finish"
-            media_files = state.get("media_files", [])
-            media_type = state.get("media_type")
+            state.step = "finish"
+            media_files = state.media_files = _uploaded_media(state)
+            media_type = state.media_type
 
             if media_files:
                 cnt = len(media_files)
@@ -4267,59 +4710,52 @@ def handle_plan_media(message):
 def save_plan_to_db(state, uid):
     """Сохраняет план в базу данных"""
     try:
-        # Сохраняем основную информацию о плане
-        cursor.execute(
-            """
-            INSERT INTO plans (title, price_cents, description, group_id, category_id, created_ts, media_file_id, media_file_ids, media_type)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-            (
-                state["title"],
-                state["price_cents"],
-                state["description"],
-                state["group_id"],
-                state["category_id"],
-                int(time.time()),
-                state["media_files"][0] if state.get("media_files") else None,
-                ",".join(state["media_files"]) if state.get("media_files") else None,
-                state.get("media_type"),
-            ),
-        )
+        now_ts = int(time.time())
 
-        plan_id = cursor.lastrowid
-
-        # Сохраняем медиа если есть
-        if state.get("media_files"):
-            for idx, file_id in enumerate(state["media_files"]):
-                cursor.execute(
-                    """
-                    INSERT INTO plan_media (plan_id, file_id, media_type, ord, added_ts)
-                    VALUES (?, ?, ?, ?, ?)
-                """,
-                    (plan_id, file_id, state["media_type"], idx, int(time.time())),
+        with conn:
+            # Сохраняем основную информацию о плане (id получаем через RETURNING)
+            plan_id = conn.execute(
+                """
+                INSERT INTO plans (title, price_cents, description, group_id, category_id, created_ts, media_file_id, media_file_ids, media_type)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                RETURNING id
+            """,
+                (
+                    state.title,
+                    state.price_cents,
+                    state.description,
+                    state.group_id,
+                    state.category_id,
+                    now_ts,
+                    state.media_files[0] if state.media_files else None,
+                    ",".join(state.media_files)
+                    if state.media_files
+                    else None,
+                    state.media_type,
+                ),
+            ).fetchone()[0]
+            # Сохраняем медиа если есть
+            if state.media_files:
+                _insert_plan_media(
+                    plan_id, state.media_files, state.media_type, now_ts
                 )
 
-        conn.commit()
-
         # Получаем название категории для сообщения
-        category = get_category_by_id(state["category_id"])
+        category = get_category_by_id(state.category_id)
         category_name = category[1] if category else "Неизвестно"
 
-        # Получаем название группы для сообщения
-        cursor.execute(
-            "SELECT title FROM managed_groups WHERE chat_id=?", (state["group_id"],)
-        )
-        group_title = cursor.fetchone()[0]
+        # Название группы сохранено в состоянии при выборе группы (select_group)
+        group_title = state.group_title
 
         bot.send_message(
-            state["chat_id"],
+            state.chat_id,
             f"✅ <b>Группа обучения создана!</b>\n\n"
-            f"🏷️ Название: {state['title']}\n"
-            f"💰 Цена: {price_str_from_cents(state['price_cents'])}\n"
+            f"🏷️ Название: {state.title}\n"
+            f"💰 Цена: {price_str_from_cents(state.price_cents)}\n"
             f"📚 Предмет: {category_name}\n"
             f"👥 Группа: {group_title}\n"
-            f"📋 Описание: {state['description']}\n"
-            f"🖼️ Медиа: {len(state.get('media_files', []))} шт.\n\n"
+            f"📋 Описание: {state.description}\n"
+            f"🖼️ Медиа: {len(state.media_files)} шт.\n\n"
             f"ID группы: {plan_id}",
             parse_mode="HTML",
             reply_markup=main_menu(uid),
@@ -4330,16 +4766,15 @@ def save_plan_to_db(state, uid):
 
     except Exception as e:
         logging.exception("Error saving plan to database")
-        bot.send_message(state["chat_id"], f"❌ Ошибка при создании группы: {str(e)}")
+        bot.send_message(state.chat_id, f"❌ Ошибка при создании группы: {str(e)}")
 
 
 # Редактирование групп
 @bot.message_handler(func=lambda message: message.text == "📝 Редактировать группу")
 @only_private
+@admin_only
 def admin_list_plans(message):
-    if message.from_user.id not in ADMIN_IDS:
-        return
-    cursor.execute(
+    cur = conn.execute(
         """
         SELECT p.id, p.title, p.price_cents, p.duration_days, p.group_id, mg.title
         FROM plans p
@@ -4348,7 +4783,7 @@ def admin_list_plans(message):
         ORDER BY p.id
     """
     )
-    rows = cursor.fetchall()
+    rows = cur.fetchall()
     if not rows:
         bot.send_message(message.chat.id, "📭 Групп обучения нет.")
         return
@@ -4375,9 +4810,8 @@ def admin_list_plans(message):
 # Управление группами
 @bot.message_handler(func=lambda message: message.text == "👥 Управление группами")
 @only_private
+@admin_only
 def cmd_groups(message):
-    if message.from_user.id not in ADMIN_IDS:
-        return
     groups = get_all_groups_with_bot()
     if not groups:
         invite_link = get_bot_invite_link()
@@ -4406,10 +4840,10 @@ def cmd_groups(message):
     text = "🏷️ Зарегистрированные группы/каналы:\n\n"
     for chat_id, title, chat_type in groups:
         bot_status = "✅ Админ" if is_bot_admin_in_chat(chat_id) else "❌ Не админ"
-        cursor.execute(
+        cur = conn.execute(
             "SELECT is_default FROM managed_groups WHERE chat_id=?", (chat_id,)
         )
-        r = cursor.fetchone()
+        r = cur.fetchone()
         is_default = r[0] if r else 0
         default_text = "✅ По умолчанию" if is_default else "❌ Не по умолчанию"
         emoji = "📢" if chat_type == "channel" else "👥"
@@ -4417,10 +4851,10 @@ def cmd_groups(message):
 
     markup = types.InlineKeyboardMarkup()
     for chat_id, title, chat_type in groups:
-        cursor.execute(
+        cur = conn.execute(
             "SELECT is_default FROM managed_groups WHERE chat_id=?", (chat_id,)
         )
-        r = cursor.fetchone()
+        r = cur.fetchone()
         is_default = r[0] if r else 0
         if not is_default:
             markup.add(
@@ -4438,9 +4872,8 @@ def cmd_groups(message):
 # Авто-добавление групп
 @bot.message_handler(func=lambda message: message.text == "🔄 Авто-добавление групп")
 @only_private
+@admin_only
 def auto_add_groups(message):
-    if message.from_user.id not in ADMIN_IDS:
-        return
     invite_link = get_bot_invite_link()
     text = (
         "🔄 <b>Автоматическое добавление групп/каналов</b>\n\n"
@@ -4454,44 +4887,46 @@ def auto_add_groups(message):
     bot.send_message(message.chat.id, text, parse_mode="HTML", reply_markup=markup)
 
 
+# Запросы админских списков (константы, чтобы кэш подготовленных выражений
+# sqlite3 всегда получал один и тот же текст)
+_SQL_RECENT_SUBS = """
+    SELECT s.id, s.user_id, s.plan_id, s.end_ts, s.active, s.group_id, p.title, s.payment_type, s.part_paid, s.current_period_month, s.current_period_year
+    FROM subscriptions s
+    LEFT JOIN plans p ON s.plan_id = p.id
+    ORDER BY s.id DESC LIMIT 50
+"""
+_SQL_RECENT_USERS = "SELECT user_id, referred_by, cashback_cents, username, join_date FROM users ORDER BY user_id DESC LIMIT 50"
+_SQL_PENDING_PAYMENTS = """
+    SELECT mp.id, mp.user_id, mp.amount_cents, mp.receipt_photo, mp.full_name, mp.created_ts, p.title, u.username, mp.payment_type
+    FROM manual_payments mp
+    LEFT JOIN plans p ON mp.plan_id = p.id
+    LEFT JOIN users u ON mp.user_id = u.user_id
+    WHERE mp.status = 'pending'
+    ORDER BY mp.created_ts
+"""
+
+
 # Просмотр подписок
 @bot.message_handler(func=lambda message: message.text == "📊 Подписки")
 @only_private
+@admin_only
 def cmd_sublist(message):
-    if message.from_user.id not in ADMIN_IDS:
-        return
-    cursor.execute(
-        """
-        SELECT s.id, s.user_id, s.plan_id, s.start_ts, s.end_ts, s.active, s.group_id, p.title, s.payment_type, s.part_paid, s.current_period_month, s.current_period_year
-        FROM subscriptions s
-        LEFT JOIN plans p ON s.plan_id = p.id
-        ORDER BY s.id DESC LIMIT 50
-    """
-    )
-    rows = cursor.fetchall()
+    rows = row_query(_SQL_RECENT_SUBS).fetchall()
     if not rows:
         bot.send_message(message.chat.id, "📭 Подписок нет.")
         return
-    text = "📊 Последние подписки:\n\n"
+    parts = ["📊 Последние подписки:\n\n"]
     current_month, current_year = get_current_period()
+    now_ts = int(time.time())
 
-    for (
-        sid,
-        uid,
-        pid,
-        st,
-        et,
-        active,
-        gid,
-        ptitle,
-        payment_type,
-        part_paid,
-        period_month,
-        period_year,
-    ) in rows:
-        status = "✅ Активна" if active else "❌ Неактивна"
+    for row in rows:
+        status = "✅ Активна" if row["active"] else "❌ Неактивна"
 
-        if period_month == current_month and period_year == current_year:
+        if (
+            row["current_period_month"] == current_month
+            and row["current_period_year"] == current_year
+        ):
+            part_paid = row["part_paid"]
             if part_paid == "full":
                 payment_status = "💰 Оплачено полностью"
             elif part_paid == "first":
@@ -4501,130 +4936,155 @@ def cmd_sublist(message):
         else:
             payment_status = "📅 Требуется оплата за новый месяц"
 
-        time_left = et - int(time.time())
+        time_left = row["end_ts"] - now_ts
         days_left = max(0, time_left // (24 * 3600))
-        text += f"🎫 #{sid} | 👤 {uid} | 🏷️ {ptitle or pid}\n💳 {payment_type} | {payment_status}\n📊 {status} | ⏰ Осталось: {days_left}д\n🏠 Группа: {gid}\n\n"
-    bot.send_message(message.chat.id, text)
+        parts.append(
+            f"🎫 #{row['id']} | 👤 {row['user_id']} | 🏷️ {row['title'] or row['plan_id']}\n💳 {row['payment_type']} | {payment_status}\n📊 {status} | ⏰ Осталось: {days_left}д\n🏠 Группа: {row['group_id']}\n\n"
+        )
+    bot.send_message(message.chat.id, "".join(parts))
 
 
 # Просмотр пользователей
 @bot.message_handler(func=lambda message: message.text == "👤 Пользователи")
 @only_private
+@admin_only
 def cmd_users(message):
-    if message.from_user.id not in ADMIN_IDS:
-        return
-    cursor.execute(
-        "SELECT user_id, referred_by, cashback_cents, username, join_date FROM users ORDER BY user_id DESC LIMIT 50"
-    )
-    rows = cursor.fetchall()
+    cur = conn.execute(_SQL_RECENT_USERS)
+    rows = cur.fetchall()
     if not rows:
         bot.send_message(message.chat.id, "📭 Нет пользователей.")
         return
-    text = "👤 Последние пользователи:\n\n"
+    parts = ["👤 Последние пользователи:\n\n"]
     for user_id, referred_by, cashback_cents, username, join_date in rows:
         ref_text = f"👥 Реферер: {referred_by}" if referred_by else "🚫 Без реферера"
         join_date_str = (
-            datetime.fromtimestamp(join_date, LOCAL_TZ).strftime("%Y-%m-%d")
+            fmt_ts(join_date, "%Y-%m-%d")
             if join_date
             else "N/A"
         )
-        text += f"🆔 ID: {user_id}\n👤 Username: {username or 'N/A'}\n{ref_text}\n💰 Баланс: {price_str_from_cents(cashback_cents)}\n📅 Регистрация: {join_date_str}\n\n"
-    bot.send_message(message.chat.id, text)
+        parts.append(
+            f"🆔 ID: {user_id}\n👤 Username: {username or 'N/A'}\n{ref_text}\n💰 Баланс: {price_str_from_cents(cashback_cents)}\n📅 Регистрация: {join_date_str}\n\n"
+        )
+    bot.send_message(message.chat.id, "".join(parts))
+
+
+# Клавиатура экрана управления оплатой (статическая, строится один раз)
+PAYMENT_MGMT_MARKUP = types.InlineKeyboardMarkup()
+PAYMENT_MGMT_MARKUP.row(
+    types.InlineKeyboardButton(
+        "🔧 Настроить карту", callback_data="config_payment:card"
+    ),
+    types.InlineKeyboardButton(
+        "🔧 Настроить ручную", callback_data="config_payment:manual"
+    ),
+)
+PAYMENT_MGMT_MARKUP.row(
+    types.InlineKeyboardButton(
+        "🔄 Переключить карту", callback_data="toggle_payment:card"
+    ),
+    types.InlineKeyboardButton(
+        "🔄 Переключить ручную", callback_data="toggle_payment:manual"
+    ),
+)
 
 
 # Управление оплатой
 @bot.message_handler(func=lambda message: message.text == "💳 Управление оплатой")
 @only_private
+@admin_only
 def cmd_payment_management(message):
-    if message.from_user.id not in ADMIN_IDS:
-        return
     methods = get_active_payment_methods()
     text = "💳 <b>Управление способами оплаты</b>\n\n"
     for method_id, name, mtype, description, details in methods:
         status = "✅ Включен"
         text += f"<b>{name}</b> ({mtype})\n{description}\nСтатус: {status}\nID: {method_id}\n\n"
 
-    markup = types.InlineKeyboardMarkup()
-    markup.row(
-        types.InlineKeyboardButton(
-            "🔧 Настроить карту", callback_data="config_payment:card"
-        ),
-        types.InlineKeyboardButton(
-            "🔧 Настроить ручную", callback_data="config_payment:manual"
-        ),
-    )
-    markup.row(
-        types.InlineKeyboardButton(
-            "🔄 Переключить карту", callback_data="toggle_payment:card"
-        ),
-        types.InlineKeyboardButton(
-            "🔄 Переключить ручную", callback_data="toggle_payment:manual"
-        ),
+    bot.send_message(
+        message.chat.id, text, parse_mode="HTML", reply_markup=PAYMENT_MGMT_MARKUP
     )
-    bot.send_message(message.chat.id, text, parse_mode="HTML", reply_markup=markup)
+
+
+def payment_review_markup(payment_ids):
+    """Кнопки одобрения/отклонения; для нескольких заявок — с номером заявки"""
+    markup = types.InlineKeyboardMarkup()
+    for payment_id in payment_ids:
+        suffix = f" #{payment_id}" if len(payment_ids) > 1 else ""
+        markup.row(
+            types.InlineKeyboardButton(
+                f"✅ Одобрить{suffix}", callback_data=f"approve_payment:{payment_id}"
+            ),
+            types.InlineKeyboardButton(
+                f"❌ Отклонить{suffix}", callback_data=f"reject_payment:{payment_id}"
+            ),
+        )
+    return markup
 
 
 # Заявки на оплату
 @bot.message_handler(func=lambda message: message.text == "📋 Заявки на оплату")
 @only_private
+@admin_only
 def cmd_pending_payments(message):
-    if message.from_user.id not in ADMIN_IDS:
-        return
-    cursor.execute(
-        """
-        SELECT mp.id, mp.user_id, mp.plan_id, mp.amount_cents, mp.receipt_photo, mp.full_name, mp.created_ts, p.title, u.username, mp.payment_type
-        FROM manual_payments mp
-        LEFT JOIN plans p ON mp.plan_id = p.id
-        LEFT JOIN users u ON mp.user_id = u.user_id
-        WHERE mp.status = 'pending'
-        ORDER BY mp.created_ts
-    """
-    )
-    rows = cursor.fetchall()
+    rows = row_query(_SQL_PENDING_PAYMENTS).fetchall()
     if not rows:
         bot.send_message(message.chat.id, "📭 Нет ожидающих заявок на оплату.")
         return
 
+    with_photos = []
     for row in rows:
-        (
-            payment_id,
-            user_id,
-            plan_id,
-            amount_cents,
-            receipt_photo,
-            full_name,
-            created_ts,
-            plan_title,
-            username,
-            payment_type,
-        ) = row
-        payment_type_text = get_payment_type_text(payment_type)
+        payment_id = row["id"]
 
         text = (
             f"📋 <b>Заявка на оплату #{payment_id}</b>\n\n"
-            f"👤 Пользователь: {username or 'N/A'} (ID: {user_id})\n"
-            f"🏷️ Группа: {plan_title}\n"
-            f"💵 Сумма: {price_str_from_cents(amount_cents)}\n"
-            f"💳 Тип оплаты: {payment_type_text}\n"
-            f"👤 ФИО: {full_name}\n"
-            f"⏰ Время заявки: {datetime.fromtimestamp(created_ts, LOCAL_TZ).strftime('%Y-%m-%d %H:%M:%S')}"
+            f"👤 Пользователь: {row['username'] or 'N/A'} (ID: {row['user_id']})\n"
+            f"🏷️ Группа: {row['title']}\n"
+            f"💵 Сумма: {price_str_from_cents(row['amount_cents'])}\n"
+            f"💳 Тип оплаты: {get_payment_type_text(row['payment_type'])}\n"
+            f"👤 ФИО: {row['full_name']}\n"
+            f"⏰ Время заявки: {fmt_ts(row['created_ts'])}"
         )
 
-        markup = types.InlineKeyboardMarkup()
-        markup.row(
-            types.InlineKeyboardButton(
-                "✅ Одобрить", callback_data=f"approve_payment:{payment_id}"
-            ),
-            types.InlineKeyboardButton(
-                "❌ Отклонить", callback_data=f"reject_payment:{payment_id}"
-            ),
-        )
+        if row["receipt_photo"]:
+            with_photos.append((payment_id, row["receipt_photo"], text))
+        else:
+            bot.send_message(
+                message.chat.id,
+                text,
+                parse_mode="HTML",
+                reply_markup=payment_review_markup([payment_id]),
+            )
+
+    # Чеки отправляем альбомами до 10 штук; к альбому нельзя прикрепить
+    # инлайн-кнопки, поэтому они идут следующим сообщением
+    for i in range(0, len(with_photos), 10):
+        chunk = with_photos[i : i + 10]
+        if len(chunk) > 1:
+            try:
+                bot.send_media_group(
+                    message.chat.id,
+                    [
+                        types.InputMediaPhoto(
+                            photo, caption=safe_caption(text), parse_mode="HTML"
+                        )
+                        for _, photo, text in chunk
+                    ],
+                )
+                bot.send_message(
+                    message.chat.id,
+                    "👆 Решения по заявкам из альбома:",
+                    reply_markup=payment_review_markup([pid for pid, _, _ in chunk]),
+                )
+                continue
+            except Exception as e:
+                logging.warning(f"Не удалось отправить альбом с чеками: {e}")
 
-        if receipt_photo:
+        # Одиночный чек или альбом не ушёл — отправляем по одному
+        for payment_id, photo, text in chunk:
+            markup = payment_review_markup([payment_id])
             try:
                 bot.send_photo(
                     message.chat.id,
-                    receipt_photo,
+                    photo,
                     caption=text,
                     parse_mode="HTML",
                     reply_markup=markup,
@@ -4632,23 +5092,17 @@ def cmd_pending_payments(message):
             except:
                 bot.send_message(
                     message.chat.id,
-                    text + f"\n\n📎 Чек: {receipt_photo}",
+                    text + f"\n\n📎 Чек: {photo}",
                     parse_mode="HTML",
                     reply_markup=markup,
                 )
-        else:
-            bot.send_message(
-                message.chat.id, text, parse_mode="HTML", reply_markup=markup
-            )
 
 
 # Управление промокодами
 @bot.message_handler(func=lambda message: message.text == "🎫 Промокоды")
 @only_private
+@admin_only
 def cmd_promo_codes(message):
-    if message.from_user.id not in ADMIN_IDS:
-        return
-
     markup = types.InlineKeyboardMarkup()
     markup.row(
         types.InlineKeyboardButton("➕ Создать промокод", callback_data="create_promo"),
@@ -4664,41 +5118,36 @@ def cmd_promo_codes(message):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("select_group:")
 )
+@admin_only
 def callback_select_group(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     group_data = call.data.split(":")[1]
     uid = call.from_user.id
     state = admin_states.get(uid)
 
-    if not state or state.get("step") != "group":
+    if not state or state.step != "group":
         bot.answer_callback_query(call.id, "❌ Сессия устарела.")
         return
 
     if group_data == "default":
-        group_id = get_default_group()
+        group_id, group_title = get_default_group_with_title()
         if not group_id:
             bot.answer_callback_query(call.id, "❌ Группа по умолчанию не установлена.")
             return
-        state["group_id"] = group_id
-        cursor.execute("SELECT title FROM managed_groups WHERE chat_id=?", (group_id,))
-        group_title = cursor.fetchone()[0]
+        state.group_id = group_id
         bot.answer_callback_query(
             call.id, f"✅ Выбрана группа по умолчанию: {group_title}"
         )
     else:
         group_id = int(group_data)
-        state["group_id"] = group_id
-        cursor.execute("SELECT title FROM managed_groups WHERE chat_id=?", (group_id,))
-        group_title = cursor.fetchone()[0]
+        state.group_id = group_id
+        group_title = get_group_title(group_id)
         bot.answer_callback_query(call.id, f"✅ Выбрана группа: {group_title}")
 
-    state["step"] = "media"
-    if "media_files" not in state:
-        state["media_files"] = []
-    state["media_type"] = None
+    state.group_title = group_title
+    state.step = "media"
+    # На шаге загрузки копим медиа в deque; в список превращаем при завершении
+    _start_media_upload(state)
+    state.media_type = None
 
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
     markup.row(
@@ -4707,7 +5156,7 @@ def callback_select_group(call):
     )
 
     bot.edit_message_text(
-        f"Шаг 5/6: Прикрепите фото/видео превью для группы '{state['title']}' (можно несколько).\nГруппа: {group_title}\n\nКогда закончите - нажмите '✅ Завершить добавление медиа'.",
+        f"Шаг 5/6: Прикрепите фото/видео превью для группы '{state.title}' (можно несколько).\nГруппа: {group_title}\n\nКогда закончите - нажмите '✅ Завершить добавление медиа'.",
         call.message.chat.id,
         call.message.message_id,
         reply_markup=None,
@@ -4722,14 +5171,11 @@ def callback_select_group(call):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("set_default:")
 )
+@admin_only
 def callback_set_default(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
     chat_id = int(call.data.split(":")[1])
     set_default_group(chat_id)
-    cursor.execute("SELECT title FROM managed_groups WHERE chat_id=?", (chat_id,))
-    title = cursor.fetchone()[0]
+    title = get_group_title(chat_id)
     bot.answer_callback_query(call.id, f"✅ Группа '{title}' установлена по умолчанию!")
     try:
         bot.edit_message_text(
@@ -4742,11 +5188,8 @@ def callback_set_default(call):
 
 
 @bot.callback_query_handler(func=lambda call: call.data == "auto_add_groups")
+@admin_only
 def callback_auto_add_groups(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     invite_link = get_bot_invite_link()
     text = (
         "🔄 <b>Автоматическое добавление групп/каналов</b>\n\n"
@@ -4766,25 +5209,35 @@ def callback_auto_add_groups(call):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("viewmedia:")
 )
+@admin_only
 def callback_viewmedia(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
     pid = int(call.data.split(":")[1])
-    cursor.execute(
+    cur = conn.execute(
         "SELECT file_id, media_type FROM plan_media WHERE plan_id=? ORDER BY ord",
         (pid,),
     )
-    rows = cursor.fetchall()
+    rows = cur.fetchall()
     if not rows:
         bot.answer_callback_query(call.id, "📭 Медиа у группы не найдены.")
         return
     try:
-        for fid, mtype in rows:
-            if mtype == "photo":
-                bot.send_photo(call.message.chat.id, fid)
+        media = [
+            (
+                types.InputMediaPhoto(fid)
+                if mtype == "photo"
+                else types.InputMediaVideo(fid)
+            )
+            for fid, mtype in rows
+        ]
+        # Telegram принимает в одном альбоме от 2 до 10 элементов
+        for i in range(0, len(media), 10):
+            chunk = media[i : i + 10]
+            if len(chunk) > 1:
+                bot.send_media_group(call.message.chat.id, chunk)
+            elif isinstance(chunk[0], types.InputMediaPhoto):
+                bot.send_photo(call.message.chat.id, chunk[0].media)
             else:
-                bot.send_video(call.message.chat.id, fid)
+                bot.send_video(call.message.chat.id, chunk[0].media)
     except:
         pass
     bot.answer_callback_query(call.id, "📦 Все медиа отправлены (если были).")
@@ -4793,10 +5246,8 @@ def callback_viewmedia(call):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("delplan:")
 )
+@admin_only
 def callback_delplan(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
     pid = int(call.data.split(":")[1])
     markup = types.InlineKeyboardMarkup()
     markup.add(
@@ -4814,15 +5265,15 @@ def callback_delplan(call):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("confirm_del:")
 )
+@admin_only
 def callback_confirm_del(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
     pid = int(call.data.split(":")[1])
     try:
-        cursor.execute("DELETE FROM plan_media WHERE plan_id=?", (pid,))
-        cursor.execute("UPDATE plans SET is_active=0 WHERE id=?", (pid,))
-        conn.commit()
+        # Удаляем медиа и деактивируем группу одной транзакцией
+        with conn:
+            conn.execute(_SQL_DELETE_PLAN_MEDIA, (pid,))
+            conn.execute("UPDATE plans SET is_active=0 WHERE id=?", (pid,))
+        _invalidate_media_group(pid)
         bot.answer_callback_query(call.id, "✅ Группа обучения удалена.")
         try:
             bot.edit_message_text(
@@ -4845,50 +5296,52 @@ def callback_confirm_del(call):
         or call.data.startswith("reject_payment:")
     )
 )
+@admin_only
 def handle_payment_review(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     is_approve = call.data.startswith("approve_payment:")
     payment_id = int(call.data.split(":")[1])
 
-    cursor.execute(
-        """
-        SELECT mp.user_id, mp.plan_id, mp.amount_cents, p.title, u.username, mp.payment_type
-        FROM manual_payments mp
-        LEFT JOIN plans p ON mp.plan_id = p.id
-        LEFT JOIN users u ON mp.user_id = u.user_id
-        WHERE mp.id = ? AND mp.status = 'pending'
-    """,
-        (payment_id,),
-    )
+    # Атомарно забираем заявку из статуса pending и сразу получаем её данные,
+    # повторное нажатие (или второй админ) получит пустой результат
+    with conn:
+        payment = conn.execute(
+            """
+            UPDATE manual_payments SET status=?, admin_id=?, reviewed_ts=?
+            WHERE id = ? AND status = 'pending'
+            RETURNING user_id, plan_id, payment_type,
+                (SELECT title FROM plans WHERE id = manual_payments.plan_id),
+                (SELECT username FROM users WHERE user_id = manual_payments.user_id)
+        """,
+            (
+                "approved" if is_approve else "rejected",
+                call.from_user.id,
+                int(time.time()),
+                payment_id,
+            ),
+        ).fetchone()
 
-    payment = cursor.fetchone()
     if not payment:
         bot.answer_callback_query(call.id, "❌ Заявка не найдена или уже обработана.")
         return
 
-    user_id, plan_id, amount_cents, plan_title, username, payment_type = payment
+    user_id, plan_id, payment_type, plan_title, username = payment
 
     if is_approve:
-        # Одобряем заявку
-        success, result = activate_subscription(user_id, plan_id, payment_type)
+        # Одобряем заявку. Если выдача подписки упала (например, "database is
+        # locked"), заявка не должна остаться approved без подписки
+        try:
+            success, result = activate_subscription(user_id, plan_id, payment_type)
+        except Exception as e:
+            logging.exception(f"Не удалось выдать подписку по заявке {payment_id}")
+            conn.rollback()  # недописанные изменения activate_subscription
+            success, result = False, str(e)
         if success:
-            cursor.execute(
-                "UPDATE manual_payments SET status='approved', admin_id=?, reviewed_ts=? WHERE id=?",
-                (call.from_user.id, int(time.time()), payment_id),
+            # Уведомляем пользователя в фоне
+            _notify_pool.submit(
+                _safe_send,
+                user_id,
+                f"✅ Ваша заявка на группу '{plan_title}' одобрена!\n\n🔗 Ваша пригласительная ссылка (одноразовая):\n{result}",
             )
-            conn.commit()
-
-            # Уведомляем пользователя
-            try:
-                bot.send_message(
-                    user_id,
-                    f"✅ Ваша заявка на группу '{plan_title}' одобрена!\n\n🔗 Ваша пригласительная ссылка (одноразовая):\n{result}",
-                )
-            except:
-                pass
 
             bot.answer_callback_query(call.id, "✅ Заявка одобрена!")
             try:
@@ -4900,23 +5353,20 @@ def handle_payment_review(call):
             except:
                 pass
         else:
+            # Подписку выдать не удалось — возвращаем заявку в очередь
+            with conn:
+                conn.execute(
+                    "UPDATE manual_payments SET status='pending', admin_id=NULL, reviewed_ts=NULL WHERE id=?",
+                    (payment_id,),
+                )
             bot.answer_callback_query(call.id, f"❌ Ошибка: {result}")
     else:
-        # Отклоняем заявку
-        cursor.execute(
-            "UPDATE manual_payments SET status='rejected', admin_id=?, reviewed_ts=? WHERE id=?",
-            (call.from_user.id, int(time.time()), payment_id),
+        # Заявка уже отклонена запросом выше, уведомляем пользователя в фоне
+        _notify_pool.submit(
+            _safe_send,
+            user_id,
+            f"❌ Ваша заявка на группу '{plan_title}' отклонена. Если вы считаете это ошибкой, свяжитесь с администратором.",
         )
-        conn.commit()
-
-        # Уведомляем пользователя
-        try:
-            bot.send_message(
-                user_id,
-                f"❌ Ваша заявка на группу '{plan_title}' отклонена. Если вы считаете это ошибкой, свяжитесь с администратором.",
-            )
-        except:
-            pass
 
         bot.answer_callback_query(call.id, "❌ Заявка отклонена!")
         try:
@@ -4933,18 +5383,15 @@ def handle_payment_review(call):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("config_payment:")
 )
+@admin_only
 def callback_config_payment(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     payment_type = call.data.split(":")[1]
 
-    cursor.execute(
+    cur = conn.execute(
         "SELECT id, name, description, details FROM payment_methods WHERE type=?",
         (payment_type,),
     )
-    method = cursor.fetchone()
+    method = cur.fetchone()
 
     if not method:
         bot.answer_callback_query(call.id, "❌ Способ оплаты не найден.")
@@ -4961,11 +5408,14 @@ def callback_config_payment(call):
         f"Пример:\n<code>Оплата картой|Реквизиты: 0000 0000 0000 0000</code>"
     )
 
-    admin_states[call.from_user.id] = {
-        "mode": "config_payment",
-        "method_id": method_id,
-        "chat_id": call.message.chat.id,
-    }
+    start_admin_session(
+        call.from_user.id,
+        AdminState(
+            mode="config_payment",
+            method_id=method_id,
+            chat_id=call.message.chat.id,
+        ),
+    )
 
     bot.answer_callback_query(call.id, "✏️ Введите новые настройки")
     bot.send_message(call.message.chat.id, text, parse_mode="HTML")
@@ -4974,17 +5424,14 @@ def callback_config_payment(call):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("toggle_payment:")
 )
+@admin_only
 def callback_toggle_payment(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     payment_type = call.data.split(":")[1]
 
-    cursor.execute(
+    cur = conn.execute(
         "SELECT id, is_active FROM payment_methods WHERE type=?", (payment_type,)
     )
-    method = cursor.fetchone()
+    method = cur.fetchone()
 
     if not method:
         bot.answer_callback_query(call.id, "❌ Способ оплаты не найден.")
@@ -4993,52 +5440,29 @@ def callback_toggle_payment(call):
     method_id, is_active = method
     new_status = 0 if is_active else 1
 
-    cursor.execute(
+    conn.execute(
         "UPDATE payment_methods SET is_active=? WHERE id=?", (new_status, method_id)
     )
     conn.commit()
+    _invalidate_payment_methods()
 
     status_text = "включен" if new_status else "выключен"
     bot.answer_callback_query(call.id, f"✅ Способ оплаты {status_text}!")
 
     # Обновляем сообщение
-    methods = get_active_payment_methods()
+    methods = get_all_payment_methods()
     text = "💳 <b>Управление способами оплаты</b>\n\n"
-    for method_id, name, mtype, description, details in methods:
-        status = (
-            "✅ Включен"
-            if cursor.execute(
-                "SELECT is_active FROM payment_methods WHERE id=?", (method_id,)
-            ).fetchone()[0]
-            else "❌ Выключен"
-        )
+    for method_id, name, mtype, description, details, is_active in methods:
+        status = "✅ Включен" if is_active else "❌ Выключен"
         text += f"<b>{name}</b> ({mtype})\n{description}\nСтатус: {status}\nID: {method_id}\n\n"
 
-    markup = types.InlineKeyboardMarkup()
-    markup.row(
-        types.InlineKeyboardButton(
-            "🔧 Настроить карту", callback_data="config_payment:card"
-        ),
-        types.InlineKeyboardButton(
-            "🔧 Настроить ручную", callback_data="config_payment:manual"
-        ),
-    )
-    markup.row(
-        types.InlineKeyboardButton(
-            "🔄 Переключить карту", callback_data="toggle_payment:card"
-        ),
-        types.InlineKeyboardButton(
-            "🔄 Переключить ручную", callback_data="toggle_payment:manual"
-        ),
-    )
-
     try:
         bot.edit_message_text(
             text,
             call.message.chat.id,
             call.message.message_id,
             parse_mode="HTML",
-            reply_markup=markup,
+            reply_markup=PAYMENT_MGMT_MARKUP,
         )
     except:
         pass
@@ -5046,15 +5470,14 @@ def callback_toggle_payment(call):
 
 @bot.message_handler(
     func=lambda m: m.from_user
-    and m.from_user.id in admin_states
-    and admin_states.get(m.from_user.id, {}).get("mode") == "config_payment"
+    and _admin_state_is(m.from_user.id, "config_payment")
     and m.chat.type == "private"
 )
 def handle_payment_config(message):
     uid = message.from_user.id
     state = admin_states.get(uid)
 
-    if not state or state.get("chat_id") != message.chat.id:
+    if not state or state.chat_id != message.chat.id:
         return
 
     if not message.text or "|" not in message.text:
@@ -5067,36 +5490,39 @@ def handle_payment_config(message):
     description = parts[0].strip()
     details = parts[1].strip()
 
-    cursor.execute(
+    conn.execute(
         "UPDATE payment_methods SET description=?, details=? WHERE id=?",
-        (description, details, state["method_id"]),
+        (description, details, state.method_id),
     )
     conn.commit()
+    _invalidate_payment_methods()
 
     admin_states.pop(uid, None)
     bot.send_message(message.chat.id, "✅ Настройки способа оплаты обновлены!")
 
 
+# Клавиатура выбора типа скидки промокода
+PROMO_TYPE_MARKUP = types.InlineKeyboardMarkup()
+PROMO_TYPE_MARKUP.row(
+    types.InlineKeyboardButton(
+        "📊 Процентная скидка", callback_data="promo_type:percent"
+    ),
+    types.InlineKeyboardButton(
+        "💵 Фиксированная скидка", callback_data="promo_type:fixed"
+    ),
+)
+
+
 # Управление промокодами
 @bot.callback_query_handler(func=lambda call: call.data == "create_promo")
+@admin_only
 def callback_create_promo(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
-    admin_states[call.from_user.id] = {
-        "mode": "create_promo",
-        "step": "type",
-        "chat_id": call.message.chat.id,
-    }
-
-    markup = types.InlineKeyboardMarkup()
-    markup.row(
-        types.InlineKeyboardButton(
-            "📊 Процентная скидка", callback_data="promo_type:percent"
-        ),
-        types.InlineKeyboardButton(
-            "💵 Фиксированная скидка", callback_data="promo_type:fixed"
+    start_admin_session(
+        call.from_user.id,
+        AdminState(
+            mode="create_promo",
+            step="type",
+            chat_id=call.message.chat.id,
         ),
     )
 
@@ -5104,27 +5530,24 @@ def callback_create_promo(call):
     bot.send_message(
         call.message.chat.id,
         "🎫 Создание промокода\n\nВыберите тип скидки:",
-        reply_markup=markup,
+        reply_markup=PROMO_TYPE_MARKUP,
     )
 
 
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("promo_type:")
 )
+@admin_only
 def callback_promo_type(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     promo_type = call.data.split(":")[1]
     uid = call.from_user.id
 
-    if uid not in admin_states or admin_states[uid].get("mode") != "create_promo":
+    if uid not in admin_states or admin_states[uid].mode != "create_promo":
         bot.answer_callback_query(call.id, "❌ Сессия устарела.")
         return
 
-    admin_states[uid]["promo_type"] = promo_type
-    admin_states[uid]["step"] = "value"
+    admin_states[uid].promo_type = promo_type
+    admin_states[uid].step = "value"
 
     if promo_type == "percent":
         text = "Введите размер скидки в процентах (например: 10 для 10%):"
@@ -5137,19 +5560,17 @@ def callback_promo_type(call):
 
 @bot.message_handler(
     func=lambda m: m.from_user
-    and m.from_user.id in admin_states
-    and admin_states.get(m.from_user.id, {}).get("mode") == "create_promo"
-    and admin_states.get(m.from_user.id, {}).get("step") == "value"
+    and _admin_state_is(m.from_user.id, "create_promo", "value")
     and m.chat.type == "private"
 )
 def handle_promo_value(message):
     uid = message.from_user.id
     state = admin_states.get(uid)
 
-    if not state or state.get("chat_id") != message.chat.id:
+    if not state or state.chat_id != message.chat.id:
         return
 
-    promo_type = state.get("promo_type")
+    promo_type = state.promo_type
     value_text = message.text.strip()
 
     try:
@@ -5157,16 +5578,16 @@ def handle_promo_value(message):
             discount_percent = int(value_text)
             if discount_percent <= 0 or discount_percent > 100:
                 raise ValueError
-            state["discount_percent"] = discount_percent
-            state["discount_fixed_cents"] = 0
+            state.discount_percent = discount_percent
+            state.discount_fixed_cents = 0
         else:
             discount_cents = cents_from_str(value_text)
             if discount_cents <= 0:
                 raise ValueError
-            state["discount_percent"] = 0
-            state["discount_fixed_cents"] = discount_cents
+            state.discount_percent = 0
+            state.discount_fixed_cents = discount_cents
 
-        state["step"] = "max_uses"
+        state.step = "max_uses"
         bot.send_message(
             message.chat.id,
             "Введите максимальное количество использований (или 0 для безлимита):",
@@ -5178,16 +5599,14 @@ def handle_promo_value(message):
 
 @bot.message_handler(
     func=lambda m: m.from_user
-    and m.from_user.id in admin_states
-    and admin_states.get(m.from_user.id, {}).get("mode") == "create_promo"
-    and admin_states.get(m.from_user.id, {}).get("step") == "max_uses"
+    and _admin_state_is(m.from_user.id, "create_promo", "max_uses")
     and m.chat.type == "private"
 )
 def handle_promo_max_uses(message):
     uid = message.from_user.id
     state = admin_states.get(uid)
 
-    if not state or state.get("chat_id") != message.chat.id:
+    if not state or state.chat_id != message.chat.id:
         return
 
     try:
@@ -5195,8 +5614,8 @@ def handle_promo_max_uses(message):
         if max_uses < 0:
             raise ValueError
 
-        state["max_uses"] = max_uses if max_uses > 0 else None
-        state["step"] = "expires"
+        state.max_uses = max_uses if max_uses > 0 else None
+        state.step = "expires"
 
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
         markup.row(types.KeyboardButton("⏩ Без срока"), types.KeyboardButton("7 дней"))
@@ -5210,70 +5629,70 @@ def handle_promo_max_uses(message):
         bot.send_message(message.chat.id, "❌ Неверное значение. Введите число:")
 
 
+# Варианты срока действия промокода (секунды; 0 — бессрочно)
+_PROMO_DURATIONS = {
+    "⏩ Без срока": 0,
+    "7 дней": 7 * 24 * 3600,
+    "30 дней": 30 * 24 * 3600,
+    "90 дней": 90 * 24 * 3600,
+}
+
+
 @bot.message_handler(
     func=lambda m: m.from_user
-    and m.from_user.id in admin_states
-    and admin_states.get(m.from_user.id, {}).get("mode") == "create_promo"
-    and admin_states.get(m.from_user.id, {}).get("step") == "expires"
+    and _admin_state_is(m.from_user.id, "create_promo", "expires")
     and m.chat.type == "private"
 )
 def handle_promo_expires(message):
     uid = message.from_user.id
     state = admin_states.get(uid)
 
-    if not state or state.get("chat_id") != message.chat.id:
+    if not state or state.chat_id != message.chat.id:
         return
 
-    text = message.text.strip()
-    expires_ts = None
-
-    if text == "⏩ Без срока":
-        expires_ts = None
-    elif text == "7 дней":
-        expires_ts = int(time.time()) + 7 * 24 * 3600
-    elif text == "30 дней":
-        expires_ts = int(time.time()) + 30 * 24 * 3600
-    elif text == "90 дней":
-        expires_ts = int(time.time()) + 90 * 24 * 3600
-    else:
+    delta = _PROMO_DURATIONS.get(message.text.strip())
+    if delta is None:
         bot.send_message(message.chat.id, "❌ Выберите вариант из кнопок:")
         return
+    now_ts = int(time.time())
+    expires_ts = now_ts + delta if delta else None
 
-    # Генерируем промокод
-    code = generate_promo_code()
-
-    # Сохраняем в базу
-    cursor.execute(
-        """
-        INSERT INTO promo_codes (code, discount_percent, discount_fixed_cents, max_uses, created_ts, expires_ts)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """,
-        (
-            code,
-            state["discount_percent"],
-            state["discount_fixed_cents"],
-            state["max_uses"],
-            int(time.time()),
-            expires_ts,
-        ),
-    )
+    # Генерируем промокод и сохраняем в базу; если код успели занять
+    # параллельно (UNIQUE), INSERT OR IGNORE ничего не вернёт — пробуем снова
+    while True:
+        code = generate_promo_code()
+        inserted = conn.execute(
+            """
+            INSERT OR IGNORE INTO promo_codes (code, discount_percent, discount_fixed_cents, max_uses, created_ts, expires_ts)
+            VALUES (?, ?, ?, ?, ?, ?)
+            RETURNING id
+        """,
+            (
+                code,
+                state.discount_percent,
+                state.discount_fixed_cents,
+                state.max_uses,
+                now_ts,
+                expires_ts,
+            ),
+        ).fetchone()
+        if inserted:
+            break
     conn.commit()
 
     # Формируем информацию о промокоде
     promo_info = f"🎫 Промокод: <code>{code}</code>\n"
-    if state["discount_percent"]:
-        promo_info += f"📊 Скидка: {state['discount_percent']}%\n"
+    if state.discount_percent:
+        promo_info += f"📊 Скидка: {state.discount_percent}%\n"
     else:
         promo_info += (
-            f"💵 Скидка: {price_str_from_cents(state['discount_fixed_cents'])}\n"
+            f"💵 Скидка: {price_str_from_cents(state.discount_fixed_cents)}\n"
         )
 
-    promo_info += f"🔄 Макс. использований: {state['max_uses'] or 'безлимит'}\n"
+    promo_info += f"🔄 Макс. использований: {state.max_uses or 'безлимит'}\n"
 
     if expires_ts:
-        expires_str = datetime.fromtimestamp(expires_ts, LOCAL_TZ).strftime(
-            "%Y-%m-%d %H:%M:%S"
-        )
+        expires_str = fmt_ts(expires_ts)
         promo_info += f"⏰ Действует до: {expires_str}\n"
     else:
         promo_info += "⏰ Срок действия: бессрочно\n"
@@ -5289,24 +5708,33 @@ def handle_promo_expires(message):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "list_promos")
+# Промокодов на одной странице списка (с запасом под лимит сообщения в 4096 символов)
+PROMO_PAGE_SIZE = 20
+
+
+@bot.callback_query_handler(
+    func=lambda call: call.data == "list_promos"
+    or (call.data and call.data.startswith("list_promos:"))
+)
+@admin_only
 def callback_list_promos(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
+    offset = int(call.data.split(":")[1]) if ":" in call.data else 0
 
-    cursor.execute(
-        "SELECT code, discount_percent, discount_fixed_cents, is_active, used_count, max_uses, expires_ts FROM promo_codes ORDER BY created_ts DESC"
+    # Берём на одну запись больше, чтобы понять, есть ли следующая страница
+    cur = conn.execute(
+        "SELECT code, discount_percent, discount_fixed_cents, is_active, used_count, max_uses, expires_ts FROM promo_codes ORDER BY created_ts DESC LIMIT ? OFFSET ?",
+        (PROMO_PAGE_SIZE + 1, offset),
     )
-    promos = cursor.fetchall()
+    promos = cur.fetchmany(PROMO_PAGE_SIZE + 1)
 
     if not promos:
         bot.answer_callback_query(call.id, "📭 Нет промокодов.")
         return
 
-    text = "📋 Список промокодов:\n\n"
+    has_next = len(promos) > PROMO_PAGE_SIZE
+    parts = ["📋 Список промокодов:\n\n"]
 
-    for promo in promos:
+    for promo in promos[:PROMO_PAGE_SIZE]:
         (
             code,
             discount_percent,
@@ -5317,32 +5745,43 @@ def callback_list_promos(call):
             expires_ts,
         ) = promo
 
-        text += f"🎫 <code>{code}</code>\n"
         if discount_percent:
-            text += f"📊 Скидка: {discount_percent}%\n"
+            discount_line = f"📊 Скидка: {discount_percent}%"
         else:
-            text += f"💵 Скидка: {price_str_from_cents(discount_fixed_cents)}\n"
+            discount_line = f"💵 Скидка: {price_str_from_cents(discount_fixed_cents)}"
 
         status = "✅ Активен" if is_active else "❌ Неактивен"
-        text += f"📊 Статус: {status}\n"
-        text += f"🔄 Использован: {used_count} раз"
-        if max_uses:
-            text += f" из {max_uses}\n"
-        else:
-            text += " (безлимит)\n"
+        uses_limit = f" из {max_uses}" if max_uses else " (безлимит)"
 
         if expires_ts:
-            expires_str = datetime.fromtimestamp(expires_ts, LOCAL_TZ).strftime(
-                "%Y-%m-%d %H:%M:%S"
-            )
-            text += f"⏰ Действует до: {expires_str}\n"
+            expires_str = fmt_ts(expires_ts)
+            expires_line = f"⏰ Действует до: {expires_str}"
         else:
-            text += "⏰ Срок: бессрочно\n"
+            expires_line = "⏰ Срок: бессрочно"
+
+        # Одна строка на промокод вместо нескольких конкатенаций
+        parts.append(
+            f"🎫 <code>{code}</code>\n"
+            f"{discount_line}\n"
+            f"📊 Статус: {status}\n"
+            f"🔄 Использован: {used_count} раз{uses_limit}\n"
+            f"{expires_line}\n\n"
+        )
 
-        text += "\n"
+    markup = None
+    if has_next:
+        markup = types.InlineKeyboardMarkup()
+        markup.add(
+            types.InlineKeyboardButton(
+                "➡️ Далее",
+                callback_data=f"list_promos:{offset + PROMO_PAGE_SIZE}",
+            )
+        )
 
     bot.answer_callback_query(call.id, "📋 Список промокодов")
-    bot.send_message(call.message.chat.id, text, parse_mode="HTML")
+    bot.send_message(
+        call.message.chat.id, "".join(parts), parse_mode="HTML", reply_markup=markup
+    )
 
 
 @bot.callback_query_handler(func=lambda call: call.data == "cancel")
@@ -5361,143 +5800,225 @@ def callback_show_plans_notification(call):
 
 
 # ----------------- Expiration and cleanup system -----------------
+def _next_occurrence(now, day, hour, minute):
+    """Ближайший момент day-го числа в hour:minute (по LOCAL_TZ) строго после now"""
+    year, month = now.year, now.month
+    while True:
+        candidate = LOCAL_TZ.localize(datetime(year, month, day, hour, minute))
+        if candidate > now:
+            return candidate
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
 def check_expirations_loop():
     """Проверяет истечение сроков оплаты и удаляет неуплативших - только полная оплата"""
+    # (число, час, минута, сообщение в лог, задача)
+    events = [
+        # 1-го числа в 10:00 - уведомление о необходимости оплаты
+        (
+            1,
+            10,
+            0,
+            "📅 Отправка уведомлений об оплате (1-е число)",
+            send_payment_notifications,
+        ),
+        # 4-го числа в 18:00 - Напоминание о скором дедлайне
+        (
+            4,
+            18,
+            0,
+            "⏰ Отправка напоминаний о дедлайне (4-е число)",
+            send_deadline_notifications,
+        ),
+        # 6-го числа в 00:01 - удаление тех, кто не оплатил
+        (6, 0, 1, "🗑️ Удаление неплательщиков (6-е число)", remove_unpaid_users),
+        # 7-го числа в 04:00 - чистка старых снятых подписок
+        (
+            7,
+            4,
+            0,
+            "🧹 Чистка старых подписок (7-е число)",
+            prune_stale_subscriptions,
+        ),
+    ]
+
+    last_dt = None  # момент последнего запущенного события
     while True:
         try:
+            # Спим сразу до ближайшего события, а не просыпаемся каждую минуту.
+            # Отсчёт не раньше последнего события: если настенные часы ушли
+            # назад, то же событие не запустится второй раз
             now = now_local()
-            current_day = now.day
-            current_hour = now.hour
-            current_minute = now.minute
-            current_month, current_year = get_current_period()
-            now_ts = int(time.time())
-
-            # 6-го числа в 00:01 - удаление тех, кто не оплатил
-            if current_day == 6 and current_hour == 0 and current_minute == 1:
-                logging.info("🗑️ Удаление неплательщиков (6-е число)")
-                remove_unpaid_users()
-                time.sleep(60)
-
-            # 1-го числа в 10:00 - уведомление о необходимости оплаты
-            elif current_day == 1 and current_hour == 10 and current_minute == 0:
-                logging.info("📅 Отправка уведомлений об оплате (1-е число)")
-                send_payment_notifications()
-                time.sleep(60)
-
-            # 4-го числа в 18:00 - Напоминание о скором дедлайне
-            elif current_day == 4 and current_hour == 18 and current_minute == 0:
-                logging.info("⏰ Отправка напоминаний о дедлайне (4-е число)")
-                send_deadline_notifications()
-                time.sleep(60)
+            after = max(now, last_dt) if last_dt else now
+            next_dt, log_message, job = min(
+                (
+                    (_next_occurrence(after, day, hour, minute), log_message, job)
+                    for day, hour, minute, log_message, job in events
+                ),
+                key=lambda event: event[0],
+            )
+            # time.sleep идёт по монотонным часам - досыпаем, пока настенные
+            # не дойдут до next_dt
+            while (remaining := (next_dt - now_local()).total_seconds()) > 0:
+                time.sleep(remaining)
+            last_dt = next_dt
 
-            time.sleep(60)  # Проверяем каждую минуту
+            # Период берём из момента события, время - один раз на запуск
+            logging.info(log_message)
+            job(next_dt.month, next_dt.year, int(time.time()))
 
         except Exception as e:
             logging.exception("❌ Критическая ошибка в check_expirations_loop")
             time.sleep(60)
 
 
-def remove_unpaid_users():
-    """Удаляет пользователей с истекшими подписками из групп"""
-    try:
-        current_month, current_year = get_current_period()
-        now_ts = int(time.time())
+# Сколько групп обрабатываем параллельно при удалении неплательщиков
+BAN_WORKERS = 8
 
-        # Находим пользователей, чьи подписки истекли И не оплачены на текущий месяц
-        cursor.execute(
-            """
-            SELECT DISTINCT s.id, s.user_id, s.group_id, s.plan_id, p.title, u.username
-            FROM subscriptions s
-            JOIN plans p ON s.plan_id = p.id
-            JOIN users u ON s.user_id = u.user_id
-            WHERE s.active = 1 
-            AND s.end_ts < ?
-            AND (
-                s.current_period_month != ? 
-                OR s.current_period_year != ? 
-                OR s.part_paid != 'full'
-            )
-        """,
-            (now_ts, current_month, current_year),
-        )
+# Размер порции при чтении подписок в фоновых задачах
+FETCH_BATCH_SIZE = 500
 
-        expired_subs = cursor.fetchall()
+# Истёкшие и не оплаченные за текущий месяц подписки
+_SQL_EXPIRED_SUBS = """
+    SELECT DISTINCT s.id, s.user_id, s.group_id, s.plan_id, p.title, u.username
+    FROM subscriptions s
+    JOIN plans p ON s.plan_id = p.id
+    JOIN users u ON s.user_id = u.user_id
+    WHERE s.active = 1 
+    AND s.end_ts < ?
+    AND (
+        s.current_period_month != ? 
+        OR s.current_period_year != ? 
+        OR s.part_paid != 'full'
+    )
+"""
 
-        if expired_subs:
-            logging.info(f"📊 Найдено {len(expired_subs)} подписок для удаления")
 
-            for (
-                sub_id,
-                user_id,
-                group_id,
-                plan_id,
-                plan_title,
-                username,
-            ) in expired_subs:
-                try:
-                    # Пытаемся удалить из группы
-                    if group_id:
-                        try:
-                            # Используем ban_chat_member с коротким баном (30 секунд)
-                            bot.ban_chat_member(
-                                group_id, user_id, until_date=now_ts + 30
-                            )
-                            logging.info(
-                                f"👤 Удален пользователь {username or user_id} из группы {group_id}"
-                            )
-                            time.sleep(0.5)  # Задержка для API
-                        except Exception as e:
-                            logging.warning(
-                                f"❌ Не удалось удалить пользователя {user_id} из группы {group_id}: {e}"
-                            )
-                            # Не останавливаем выполнение, продолжаем с остальными
+def _ban_group_members(group_id, members, until_date):
+    """Удаляет пользователей из одной группы (коротким баном), по очереди"""
+    for user_id, username in members:
+        try:
+            rate_limiter.acquire(group_id)
+            bot.ban_chat_member(group_id, user_id, until_date=until_date)
+            logging.info(
+                f"👤 Удален пользователь {username or user_id} из группы {group_id}"
+            )
+        except Exception as e:
+            # Не останавливаем выполнение, продолжаем с остальными
+            logging.warning(
+                f"❌ Не удалось удалить пользователя {user_id} из группы {group_id}: {e}"
+            )
 
-                    # Деактивируем подписку
-                    cursor.execute(
-                        "UPDATE subscriptions SET active = 0, removed = 1 WHERE id = ?",
-                        (sub_id,),
-                    )
-                    conn.commit()
 
-                    # Уведомляем пользователя
-                    try:
-                        bot.send_message(
-                            user_id,
-                            f"❌ Доступ к группе '{plan_title}' приостановлен.\n\n"
-                            "Вы не оплатили подписку за текущий месяц. "
-                            "Для восстановления доступа оплатите подписку в разделе '📋 Группы обучения'.",
-                        )
-                        logging.info(
-                            f"📢 Отправлено уведомление пользователю {username or user_id}"
-                        )
-                    except Exception as e:
-                        logging.warning(
-                            f"❌ Не удалось отправить уведомление пользователю {user_id}: {e}"
-                        )
+def _remove_unpaid_batch(db, expired_subs, now_ts):
+    """Удаляет из групп и деактивирует одну порцию истёкших подписок"""
+    # Баним по группам: внутри группы по очереди (лимит на чат),
+    # разные группы параллельно
+    members_by_group = {}
+    for sub_id, user_id, group_id, plan_id, plan_title, username in expired_subs:
+        if group_id:
+            members_by_group.setdefault(group_id, []).append((user_id, username))
 
-                except Exception as e:
-                    logging.error(f"❌ Ошибка обработки подписки {sub_id}: {e}")
-                    continue  # Продолжаем обработку остальных
+    with ThreadPoolExecutor(max_workers=BAN_WORKERS) as pool:
+        for group_id, members in members_by_group.items():
+            pool.submit(_ban_group_members, group_id, members, now_ts + 30)
 
-    except Exception as e:
-        logging.error(f"❌ Ошибка в remove_unpaid_users: {e}")
+    # Одна транзакция вместо commit на каждую подписку
+    with db:
+        db.executemany(
+            "UPDATE subscriptions SET active = 0, removed = 1 WHERE id = ?",
+            [(row[0],) for row in expired_subs],
+        )
+    _sub_cache.clear()
+
+    # Уведомляем пользователей
+    for sub_id, user_id, group_id, plan_id, plan_title, username in expired_subs:
+        try:
+            rate_limiter.acquire(user_id)
+            bot.send_message(
+                user_id,
+                f"❌ Доступ к группе '{plan_title}' приостановлен.\n\n"
+                "Вы не оплатили подписку за текущий месяц. "
+                "Для восстановления доступа оплатите подписку в разделе '📋 Группы обучения'.",
+            )
+            logging.info(
+                f"📢 Отправлено уведомление пользователю {username or user_id}"
+            )
+        except Exception as e:
+            logging.warning(
+                f"❌ Не удалось отправить уведомление пользователю {user_id}: {e}"
+            )
+
+
+def remove_unpaid_users(current_month=None, current_year=None, now_ts=None):
+    """Удаляет пользователей с истекшими подписками из групп"""
+    try:
+        db = get_conn()
+        cur = db.cursor()
+        if current_month is None:
+            current_month, current_year = get_current_period()
+        if now_ts is None:
+            now_ts = int(time.time())
+
+        # Находим пользователей, чьи подписки истекли И не оплачены на текущий месяц
+        cur.execute(_SQL_EXPIRED_SUBS, (now_ts, current_month, current_year))
+
+        # Читаем порциями: после долгого простоя подписок может быть много,
+        # а каждая порция фиксируется сразу и не повторяется после перезапуска
+        while True:
+            expired_subs = cur.fetchmany(FETCH_BATCH_SIZE)
+            if not expired_subs:
+                break
+            logging.info(f"📊 Найдено {len(expired_subs)} подписок для удаления")
+            _remove_unpaid_batch(db, expired_subs, now_ts)
+
+    except Exception as e:
+        logging.error(f"❌ Ошибка в remove_unpaid_users: {e}")
+
+
+# Сколько дней храним снятые подписки
+STALE_SUBS_RETENTION_DAYS = 180
+
+
+def prune_stale_subscriptions(current_month=None, current_year=None, now_ts=None):
+    """Удаляет давно снятые подписки и сжимает базу (период не используется)"""
+    try:
+        db = get_conn()
+        cur = db.cursor()
+        if now_ts is None:
+            now_ts = int(time.time())
+        cutoff_ts = now_ts - STALE_SUBS_RETENTION_DAYS * 86400
+        with db:
+            cur.execute(
+                "DELETE FROM subscriptions WHERE active = 0 AND removed = 1 AND end_ts < ?",
+                (cutoff_ts,),
+            )
+            deleted = cur.rowcount
+        _sub_cache.clear()
+        logging.info(f"🧹 Удалено {deleted} старых подписок")
+
+        if deleted:
+            # VACUUM нельзя выполнять внутри транзакции, поэтому после commit
+            cur.execute("VACUUM")
+            logging.info("🧹 База данных сжата (VACUUM)")
+    except Exception as e:
+        logging.error(f"❌ Ошибка в prune_stale_subscriptions: {e}")
 
 
 def safe_remove_from_chat(chat_id, user_id):
     """Безопасное удаление пользователя из чата"""
     try:
-        # Проверяем, есть ли пользователь в чате
-        try:
-            member = bot.get_chat_member(chat_id, user_id)
-            if member.status in ["left", "kicked"]:
-                return True  # Уже не в чате
-        except:
-            return True  # Пользователь не найден в чате
-
-        # Пытаемся удалить с коротким баном
+        # Сразу баним коротким баном: бан уже ушедшего пользователя безвреден,
+        # поэтому предварительный get_chat_member не нужен
+        rate_limiter.acquire(chat_id)
         bot.ban_chat_member(chat_id, user_id, until_date=int(time.time()) + 30)
-        time.sleep(0.3)  # Задержка для API
         return True
+    except telebot.apihelper.ApiTelegramException as e:
+        description = (e.result_json or {}).get("description", "").lower()
+        if "user not found" in description or "participant_id_invalid" in description:
+            return True  # Пользователя уже нет в чате
+        logging.error(f"Ошибка удаления пользователя {user_id} из чата {chat_id}: {e}")
+        return False
     except Exception as e:
         logging.error(f"Ошибка удаления пользователя {user_id} из чата {chat_id}: {e}")
         return False
@@ -5507,70 +6028,206 @@ def safe_remove_from_chat(chat_id, user_id):
 threading.Thread(target=check_expirations_loop, daemon=True).start()
 
 
-def send_deadline_notifications():
+# Сколько уведомлений рассылки отправляем параллельно
+NOTIFY_WORKERS = 5
+# Сколько раз повторяем уведомление после ответа 429
+NOTIFY_RETRIES = 3
+# Порядковый номер в очереди повторов: при равных сроках задачи не сравниваются
+_retry_seq = itertools.count()
+
+# Оплаченные подписки, истекающие в заданном интервале
+_SQL_DEADLINE_SUBS = """
+    SELECT s.user_id, u.username, s.plan_id, p.title, s.end_ts, p.price_cents, s.id as sub_id
+    FROM subscriptions s
+    JOIN users u ON s.user_id = u.user_id
+    JOIN plans p ON s.plan_id = p.id
+    WHERE s.active = 1 
+    AND s.end_ts BETWEEN ? AND ?
+    AND (s.current_period_month = ? AND s.current_period_year = ? AND s.part_paid = 'full')
+    ORDER BY s.end_ts
+"""
+
+# Активные подписки без полной оплаты за месяц, которым давно не напоминали
+_SQL_UNPAID_SUBS = """
+    SELECT DISTINCT s.user_id, u.username, s.plan_id, p.title, p.price_cents, s.id as sub_id
+    FROM subscriptions s
+    JOIN users u ON s.user_id = u.user_id
+    JOIN plans p ON s.plan_id = p.id
+    WHERE s.active = 1 
+    AND NOT (
+        s.current_period_month = ? 
+        AND s.current_period_year = ? 
+        AND s.part_paid = 'full'
+    )
+    AND (
+        s.last_notification_ts IS NULL
+        OR s.last_notification_ts < ?
+    )
+    ORDER BY s.user_id
+"""
+
+
+# Шаблоны рассылок (подставляются через format_map)
+TPL_DEADLINE_NOTIFY = (
+    "⏰ <b>Напоминание о дедлайне!</b>\n\n"
+    "Группа: {plan_title}\n"
+    "📅 Срок действия подписки заканчивается через {days_left} дней ({date})\n\n"
+    "💳 <b>Успейте продлить подписку!</b>\n"
+    "• Полная оплата - доступ до 5 числа следующего месяца\n\n"
+    "После истечения срока доступ к группе будет приостановлен."
+)
+TPL_PAYMENT_NOTIFY = (
+    "📅 <b>Напоминание об оплате за {month}</b>\n\n"
+    "Группа: {plan_title}\n"
+    "Наступил новый месяц! Для продолжения доступа к группе обучения необходимо оплатить подписку.\n\n"
+    "💰 Сумма к оплате: {price}\n"
+    "⏰ <b>Оплатите до 5 числа следующего месяца</b>\n\n"
+    "После истечения срока доступ к группе будет приостановлен."
+)
+
+
+def renew_plan_markup(plan_id, button_text):
+    """Клавиатура с одной кнопкой продления/оплаты группы обучения"""
+    markup = types.InlineKeyboardMarkup()
+    markup.add(
+        types.InlineKeyboardButton(button_text, callback_data=f"renew_plan:{plan_id}")
+    )
+    return markup
+
+
+def _send_notification(user_id, text, markup):
+    """Отправляет HTML-уведомление; возвращает (доставлено, retry_after при 429)"""
+    rate_limiter.acquire(user_id)
+    try:
+        bot.send_message(user_id, text, parse_mode="HTML", reply_markup=markup)
+        return True, None
+    except Exception as e:
+        retry_after = telegram_retry_after(e)
+        if retry_after:
+            # Ждёт только этот чат, остальные рассылки идут дальше
+            rate_limiter.block_chat(user_id, retry_after)
+            return False, retry_after
+        logging.error(f"Error sending notification to user {user_id}: {e}")
+        return False, None
+
+
+def _send_notification_pass(items, retry_heap):
+    """Рассылает items [(попыток осталось, задача)] параллельно; ключи доставленных
+
+    Задача - (ключ, user_id, text, markup). Получившие 429 откладываются в
+    retry_heap до срока retry_after, пока не кончатся попытки.
+    """
+    delivered = []
+    with ThreadPoolExecutor(max_workers=NOTIFY_WORKERS) as pool:
+        futures = {
+            pool.submit(_send_notification, *task[1:]): (retries_left, task)
+            for retries_left, task in items
+        }
+        for future in as_completed(futures):
+            retries_left, task = futures[future]
+            sent, retry_after = future.result()
+            if sent:
+                delivered.append(task[0])
+            elif retry_after and retries_left > 0:
+                heapq.heappush(
+                    retry_heap,
+                    (
+                        time.monotonic() + retry_after,
+                        next(_retry_seq),
+                        retries_left - 1,
+                        task,
+                    ),
+                )
+            elif retry_after:
+                logging.error(f"Notification to user {task[1]} dropped after retries")
+    return delivered
+
+
+def _deliver_notifications(tasks, retry_heap):
+    """Основной проход по порции задач; ответы 429 не ждём, а кладём в retry_heap"""
+    return _send_notification_pass(
+        [(NOTIFY_RETRIES, task) for task in tasks], retry_heap
+    )
+
+
+def _drain_notification_retries(retry_heap):
+    """Повторяет отложенные после 429 задачи (после основного прохода по всем)"""
+    delivered = []
+    while retry_heap:
+        time.sleep(max(0, retry_heap[0][0] - time.monotonic()))
+        # Забираем из очереди всё, что созрело к ближайшему сроку
+        now = time.monotonic()
+        due = []
+        while retry_heap and retry_heap[0][0] <= now:
+            _, _, retries_left, task = heapq.heappop(retry_heap)
+            due.append((retries_left, task))
+        delivered.extend(_send_notification_pass(due, retry_heap))
+    return delivered
+
+
+def send_deadline_notifications(current_month=None, current_year=None, now_ts=None):
     """Отправляет уведомления о скором дедлайне оплаты с кнопкой продления"""
     try:
-        current_month, current_year = get_current_period()
-        now_ts = int(time.time())
+        db = get_conn()
+        cur = db.cursor()
+        if current_month is None:
+            current_month, current_year = get_current_period()
+        if now_ts is None:
+            now_ts = int(time.time())
 
         # Находим подписки, которые истекают в ближайшие 5 дней
-        cursor.execute(
-            """
-            SELECT s.user_id, u.username, s.plan_id, p.title, s.end_ts, p.price_cents, s.id as sub_id
-            FROM subscriptions s
-            JOIN users u ON s.user_id = u.user_id
-            JOIN plans p ON s.plan_id = p.id
-            WHERE s.active = 1 
-            AND s.end_ts BETWEEN ? AND ?
-            AND (s.current_period_month = ? AND s.current_period_year = ? AND s.part_paid = 'full')
-            ORDER BY s.end_ts
-        """,
+        cur.execute(
+            _SQL_DEADLINE_SUBS,
             (now_ts, now_ts + 5 * 24 * 3600, current_month, current_year),
         )
 
-        users = cursor.fetchall()
-
+        # Читаем и рассылаем порциями, не загружая всю выборку в память
         notification_count = 0
-        for (
-            user_id,
-            username,
-            plan_id,
-            plan_title,
-            end_ts,
-            price_cents,
-            sub_id,
-        ) in users:
-            try:
+        markups = {}
+        retry_heap = []  # ответы 429 со всех порций, повторяем после основного прохода
+        while True:
+            users = cur.fetchmany(FETCH_BATCH_SIZE)
+            if not users:
+                break
+
+            tasks = []
+            for (
+                user_id,
+                username,
+                plan_id,
+                plan_title,
+                end_ts,
+                price_cents,
+                sub_id,
+            ) in users:
                 days_left = (end_ts - now_ts) // (24 * 3600)
 
-                text = (
-                    f"⏰ <b>Напоминание о дедлайне!</b>\n\n"
-                    f"Группа: {plan_title}\n"
-                    f"📅 Срок действия подписки заканчивается через {days_left} дней ({datetime.fromtimestamp(end_ts, LOCAL_TZ).strftime('%d.%m.%Y')})\n\n"
-                    f"💳 <b>Успейте продлить подписку!</b>\n"
-                    f"• Полная оплата - доступ до 5 числа следующего месяца\n\n"
-                    f"После истечения срока доступ к группе будет приостановлен."
+                text = TPL_DEADLINE_NOTIFY.format_map(
+                    {
+                        "plan_title": plan_title,
+                        "days_left": days_left,
+                        "date": fmt_ts(end_ts, "%d.%m.%Y"),
+                    }
                 )
 
-                markup = types.InlineKeyboardMarkup()
-                markup.add(
-                    types.InlineKeyboardButton(
-                        f"🔄 Продлить за {price_str_from_cents(price_cents)}",
-                        callback_data=f"renew_plan:{plan_id}",
+                # Кнопка зависит только от группы - собираем её один раз на группу
+                markup = markups.get(plan_id)
+                if markup is None:
+                    markup = markups[plan_id] = renew_plan_markup(
+                        plan_id, f"🔄 Продлить за {price_str_from_cents(price_cents)}"
                     )
-                )
+                tasks.append((user_id, user_id, text, markup))
 
-                bot.send_message(user_id, text, parse_mode="HTML", reply_markup=markup)
+            # Отправляем параллельно, чтобы не ждать каждый HTTP-запрос по очереди
+            for user_id in _deliver_notifications(tasks, retry_heap):
                 notification_count += 1
-
                 logging.info(
                     f"📨 Отправлено уведомление о дедлайне пользователю {user_id}"
                 )
 
-            except Exception as e:
-                logging.error(
-                    f"Error sending deadline notification to user {user_id}: {e}"
-                )
+        for user_id in _drain_notification_retries(retry_heap):
+            notification_count += 1
+            logging.info(f"📨 Отправлено уведомление о дедлайне пользователю {user_id}")
 
         logging.info(f"📊 Отправлено {notification_count} уведомлений о дедлайне")
         return notification_count
@@ -5580,81 +6237,73 @@ def send_deadline_notifications():
         return 0
 
 
-def send_payment_notifications():
+def send_payment_notifications(current_month=None, current_year=None, now_ts=None):
     """Отправляет уведомления о необходимости оплаты - только тем, кто не оплатил"""
     try:
-        current_month, current_year = get_current_period()
-        now_ts = int(time.time())
-        now = now_local()
+        db = get_conn()
+        cur = db.cursor()
+        if current_month is None:
+            current_month, current_year = get_current_period()
+        if now_ts is None:
+            now_ts = int(time.time())
+        month_label = datetime.fromtimestamp(now_ts, LOCAL_TZ).strftime("%B %Y")
         cooldown_seconds = 20 * 3600  # защита от повторных отправок при перезапусках
 
         # Находим пользователей с активными подписками, но не оплаченными на текущий месяц.
         # Важно: НЕ фильтруем по end_ts < now_ts, т.к. у нас есть льготный период до 5-го числа,
         # но напоминание нужно отправлять 1-го.
-        cursor.execute(
-            """
-            SELECT DISTINCT s.user_id, u.username, s.plan_id, p.title, p.price_cents, s.id as sub_id
-            FROM subscriptions s
-            JOIN users u ON s.user_id = u.user_id
-            JOIN plans p ON s.plan_id = p.id
-            WHERE s.active = 1 
-            AND NOT (
-                s.current_period_month = ? 
-                AND s.current_period_year = ? 
-                AND s.part_paid = 'full'
-            )
-            AND (
-                s.last_notification_ts IS NULL
-                OR s.last_notification_ts < ?
-            )
-            ORDER BY s.user_id
-        """,
+        cur.execute(
+            _SQL_UNPAID_SUBS,
             (current_month, current_year, now_ts - cooldown_seconds),
         )
 
-        users = cursor.fetchall()
+        # Читаем и рассылаем порциями; отметка об отправке фиксируется после каждой,
+        # так что перезапуск посреди рассылки не повторит уже отправленное
+        notified_sub_ids = []
+        markups = {}
+        retry_heap = []  # ответы 429 со всех порций, повторяем после основного прохода
 
-        notification_count = 0
-        for user_id, username, plan_id, plan_title, price_cents, sub_id in users:
-            try:
-                text = (
-                    f"📅 <b>Напоминание об оплате за {now.strftime('%B %Y')}</b>\n\n"
-                    f"Группа: {plan_title}\n"
-                    f"Наступил новый месяц! Для продолжения доступа к группе обучения необходимо оплатить подписку.\n\n"
-                    f"💰 Сумма к оплате: {price_str_from_cents(price_cents)}\n"
-                    f"⏰ <b>Оплатите до 5 числа следующего месяца</b>\n\n"
-                    f"После истечения срока доступ к группе будет приостановлен."
+        def mark_notified(delivered):
+            """Логирует доставленные и одним пакетом отмечает время уведомления"""
+            sub_ids = []
+            for user_id, username, sub_id in delivered:
+                sub_ids.append(sub_id)
+                logging.info(
+                    f"📨 Отправлено уведомление об оплате пользователю {user_id} ({username or 'нет username'})"
                 )
-
-                markup = types.InlineKeyboardMarkup()
-                markup.add(
-                    types.InlineKeyboardButton(
-                        f"💳 Оплатить {price_str_from_cents(price_cents)}",
-                        callback_data=f"renew_plan:{plan_id}",
-                    )
+            with db:
+                db.executemany(
+                    "UPDATE subscriptions SET last_notification_ts = ? WHERE id = ?",
+                    [(now_ts, sub_id) for sub_id in sub_ids],
                 )
-
-                bot.send_message(user_id, text, parse_mode="HTML", reply_markup=markup)
-                notification_count += 1
-
-                # Обновляем время последнего уведомления
-                cursor.execute(
-                    """
-                    UPDATE subscriptions 
-                    SET last_notification_ts = ? 
-                    WHERE id = ?
-                """,
-                    (now_ts, sub_id),
+            notified_sub_ids.extend(sub_ids)
+
+        while True:
+            users = cur.fetchmany(FETCH_BATCH_SIZE)
+            if not users:
+                break
+
+            tasks = []
+            for user_id, username, plan_id, plan_title, price_cents, sub_id in users:
+                price = price_str_from_cents(price_cents)
+                text = TPL_PAYMENT_NOTIFY.format_map(
+                    {"month": month_label, "plan_title": plan_title, "price": price}
                 )
-                conn.commit()
 
-                logging.info(
-                    f"📨 Отправлено уведомление об оплате пользователю {user_id} ({username or 'нет username'})"
-                )
+                # Кнопка зависит только от группы - собираем её один раз на группу
+                markup = markups.get(plan_id)
+                if markup is None:
+                    markup = markups[plan_id] = renew_plan_markup(
+                        plan_id, f"💳 Оплатить {price}"
+                    )
+                tasks.append(((user_id, username, sub_id), user_id, text, markup))
 
-            except Exception as e:
-                logging.error(f"Error sending notification to user {user_id}: {e}")
+            # Отправляем параллельно; БД обновляем уже в этом потоке
+            mark_notified(_deliver_notifications(tasks, retry_heap))
 
+        mark_notified(_drain_notification_retries(retry_heap))
+
+        notification_count = len(notified_sub_ids)
         logging.info(f"📊 Отправлено {notification_count} уведомлений об оплате")
         return notification_count
 
@@ -5665,9 +6314,8 @@ def send_payment_notifications():
 
 @bot.message_handler(commands=["run_payment_notifications"])
 @only_private
+@admin_only
 def cmd_run_payment_notifications(message):
-    if message.from_user.id not in ADMIN_IDS:
-        return
     cnt = send_payment_notifications()
     bot.send_message(
         message.chat.id, f"✅ Готово. Отправлено уведомлений об оплате: {cnt}"
@@ -5676,9 +6324,8 @@ def cmd_run_payment_notifications(message):
 
 @bot.message_handler(commands=["run_deadline_notifications"])
 @only_private
+@admin_only
 def cmd_run_deadline_notifications(message):
-    if message.from_user.id not in ADMIN_IDS:
-        return
     cnt = send_deadline_notifications()
     bot.send_message(
         message.chat.id, f"✅ Готово. Отправлено уведомлений о дедлайне: {cnt}"
@@ -5687,9 +6334,8 @@ def cmd_run_deadline_notifications(message):
 
 @bot.message_handler(commands=["run_remove_unpaid"])
 @only_private
+@admin_only
 def cmd_run_remove_unpaid(message):
-    if message.from_user.id not in ADMIN_IDS:
-        return
     remove_unpaid_users()
     bot.send_message(
         message.chat.id,
@@ -5697,12 +6343,25 @@ def cmd_run_remove_unpaid(message):
     )
 
 
+# Кэш результатов check_existing_subscription: {(user_id, plan_id): (ts, result)}
+SUB_CACHE_TTL = 30
+_sub_cache = {}
+
+
 def check_existing_subscription(user_id, plan_id):
     """Проверяет, есть ли у пользователя активная подписка на план"""
     current_month, current_year = get_current_period()
     now_ts = int(time.time())
 
-    cursor.execute(
+    cached = _sub_cache.get((user_id, plan_id))
+    if (
+        cached
+        and time.monotonic() - cached[0] < SUB_CACHE_TTL
+        and cached[1]["end_ts"] > now_ts
+    ):
+        return cached[1]
+
+    cur = conn.execute(
         """
         SELECT s.id, s.active, s.part_paid, s.end_ts, p.title, 
                s.current_period_month, s.current_period_year,
@@ -5717,7 +6376,7 @@ def check_existing_subscription(user_id, plan_id):
         (user_id, plan_id),
     )
 
-    existing = cursor.fetchone()
+    existing = cur.fetchone()
     if not existing:
         return None
 
@@ -5742,7 +6401,7 @@ def check_existing_subscription(user_id, plan_id):
         and end_ts > now_ts
     )
 
-    return {
+    result = {
         "id": sub_id,
         "paid": paid_for_current,  # Булево значение: True если оплачена на текущий месяц
         "active": bool(active),
@@ -5761,137 +6420,113 @@ def check_existing_subscription(user_id, plan_id):
             else "expired" if end_ts < now_ts else "needs_payment"
         ),
     }
-
-
-@bot.callback_query_handler(
-    func=lambda call: call.data and call.data.startswith("edit_field:category:")
-)
-def callback_edit_category_field(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
-    plan_id = int(call.data.split(":")[2])
-    uid = call.from_user.id
-
-    state = admin_states.get(uid)
-    if not state or state.get("mode") != "edit" or state.get("plan_id") != plan_id:
-        bot.answer_callback_query(call.id, "❌ Сессия устарела.")
-        return
-
-    state["step"] = "editing_category"
-
-    # Показываем выбор категории
-    categories = get_all_categories()
-    markup = types.InlineKeyboardMarkup()
-    for cat_id, name, description in categories:
-        button_text = name
-        if description:
-            button_text += f" - {description}"
-        markup.add(
-            types.InlineKeyboardButton(
-                button_text, callback_data=f"select_edit_category:{cat_id}:{plan_id}"
-            )
-        )
-
-    # Получаем текущую категорию
-    cursor.execute("SELECT category_id FROM plans WHERE id=?", (plan_id,))
-    current_category_id = cursor.fetchone()[0]
-
-    current_category = (
-        get_category_by_id(current_category_id) if current_category_id else None
-    )
-    current_category_name = current_category[1] if current_category else "Не указан"
-
-    bot.send_message(
-        call.message.chat.id,
-        f"📚 <b>Изменение предмета</b>\n\n"
-        f"Текущий предмет: {current_category_name}\n"
-        f"Выберите новый предмет:",
-        parse_mode="HTML",
-        reply_markup=markup,
-    )
-    bot.answer_callback_query(call.id, "Изменение предмета")
+    _sub_cache[(user_id, plan_id)] = (time.monotonic(), result)
+    return result
 
 
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("select_edit_category:")
 )
+@admin_only
 def callback_select_edit_category(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     parts = call.data.split(":")
     category_id = int(parts[1])
     plan_id = int(parts[2])
     uid = call.from_user.id
 
     state = admin_states.get(uid)
-    if not state or state.get("mode") != "edit" or state.get("plan_id") != plan_id:
+    if not state or state.mode != "edit" or state.plan_id != plan_id:
         bot.answer_callback_query(call.id, "❌ Сессия устарела.")
         return
 
     # Обновляем категорию в базе
-    cursor.execute("UPDATE plans SET category_id=? WHERE id=?", (category_id, plan_id))
-    conn.commit()
-
-    # Обновляем состояние
-    state["current_category_id"] = category_id
+    with conn:
+        conn.execute(
+            "UPDATE plans SET category_id=? WHERE id=?", (category_id, plan_id)
+        )
 
     category = get_category_by_id(category_id)
     category_name = category[1] if category else "Неизвестно"
 
+    # Обновляем состояние
+    state.current_category_id = category_id
+    state.current_category_name = category[1] if category else None
+
     bot.answer_callback_query(call.id, f"✅ Предмет изменен: {category_name}")
 
     # Возвращаемся к меню редактирования
-    state["step"] = "edit_choice"
+    state.step = "edit_choice"
     show_edit_menu(call.message.chat.id, state)
 
 
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("editplan:")
 )
+@admin_only
 def callback_edit_plan(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     pid = int(call.data.split(":")[1])
 
-    # Получаем информацию о группе
-    cursor.execute(
+    # Сначала записываем отложенные правки прежней сессии - иначе при повторном
+    # открытии той же группы ниже прочитались бы старые значения
+    previous = admin_states.get(call.from_user.id)
+    if previous is not None:
+        flush_pending_plan_fields(previous)
+
+    # Получаем информацию о группе вместе с предметом и названием чата,
+    # чтобы экраны редактирования не делали отдельных запросов
+    cur = conn.execute(
         """
-        SELECT p.id, p.title, p.price_cents, p.description, p.group_id, p.media_file_ids, p.media_type
+        SELECT p.id, p.title, p.price_cents, p.description, p.group_id, p.media_file_ids, p.media_type,
+               p.category_id, c.name, g.title
         FROM plans p
+        LEFT JOIN categories c ON c.id = p.category_id
+        LEFT JOIN managed_groups g ON g.chat_id = p.group_id
         WHERE p.id=?
     """,
         (pid,),
     )
 
-    plan = cursor.fetchone()
+    plan = cur.fetchone()
     if not plan:
         bot.answer_callback_query(call.id, "❌ Группа не найдена.")
         return
 
-    plan_id, title, price_cents, description, group_id, media_file_ids, media_type = (
-        plan
-    )
+    (
+        plan_id,
+        title,
+        price_cents,
+        description,
+        group_id,
+        media_file_ids,
+        media_type,
+        category_id,
+        category_name,
+        group_title,
+    ) = plan
 
     # Инициализируем состояние редактирования
     uid = call.from_user.id
-    admin_states[uid] = {
-        "mode": "edit",
-        "step": "edit_choice",
-        "plan_id": plan_id,
-        "current_title": title,
-        "current_price": price_cents,
-        "current_description": description,
-        "current_group_id": group_id,
-        "media_files": media_file_ids.split(",") if media_file_ids else [],
-        "media_type": media_type,
-        "chat_id": call.message.chat.id,
-    }
+    media_files = media_file_ids.split(",") if media_file_ids else []
+    start_admin_session(
+        uid,
+        AdminState(
+            mode="edit",
+            step="edit_choice",
+            plan_id=plan_id,
+            current_title=title,
+            current_price=price_cents,
+            current_description=description,
+            current_group_id=group_id,
+            current_group_title=group_title,
+            current_category_id=category_id,
+            current_category_name=category_name,
+            media_files=media_files,
+            media_type=media_type,
+            # Что сейчас лежит в базе - чтобы не перезаписывать те же медиа
+            saved_media_key=(media_type, tuple(media_files)),
+            chat_id=call.message.chat.id,
+        ),
+    )
 
     markup = types.InlineKeyboardMarkup()
     markup.row(
@@ -5933,37 +6568,63 @@ def callback_edit_plan(call):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("edit_field:")
 )
+@admin_only
 def callback_edit_field(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     parts = call.data.split(":")
     field = parts[1]
     plan_id = int(parts[2])
     uid = call.from_user.id
 
     state = admin_states.get(uid)
-    if not state or state.get("mode") != "edit" or state.get("plan_id") != plan_id:
+    if not state or state.mode != "edit" or state.plan_id != plan_id:
         bot.answer_callback_query(call.id, "❌ Сессия устарела.")
         return
 
-    state["step"] = f"editing_{field}"
+    state.step = f"editing_{field}"
+
+    if field == "category":
+        # Показываем выбор категории
+        categories = get_all_categories()
+        markup = types.InlineKeyboardMarkup()
+        for cat_id, name, description in categories:
+            button_text = name
+            if description:
+                button_text += f" - {description}"
+            markup.add(
+                types.InlineKeyboardButton(
+                    button_text,
+                    callback_data=f"select_edit_category:{cat_id}:{plan_id}",
+                )
+            )
+
+        # Текущая категория уже загружена в состояние при входе в редактирование
+        current_category_name = state.current_category_name or "Не указан"
+
+        bot.send_message(
+            call.message.chat.id,
+            f"📚 <b>Изменение предмета</b>\n\n"
+            f"Текущий предмет: {current_category_name}\n"
+            f"Выберите новый предмет:",
+            parse_mode="HTML",
+            reply_markup=markup,
+        )
+        bot.answer_callback_query(call.id, "Изменение предмета")
+        return
 
     if field == "title":
         bot.send_message(
             call.message.chat.id,
-            f"✏️ Текущее название: {state['current_title']}\nВведите новое название:",
+            f"✏️ Текущее название: {state.current_title}\nВведите новое название:",
         )
     elif field == "price":
         bot.send_message(
             call.message.chat.id,
-            f"✏️ Текущая цена: {price_str_from_cents(state['current_price'])}\nВведите новую цену (например: 14.99):",
+            f"✏️ Текущая цена: {price_str_from_cents(state.current_price)}\nВведите новую цену (например: 14.99):",
         )
     elif field == "description":
         bot.send_message(
             call.message.chat.id,
-            f"✏️ Текущее описание: {state['current_description']}\nВведите новое описание:",
+            f"✏️ Текущее описание: {state.current_description}\nВведите новое описание:",
         )
     elif field == "group":
         groups = get_all_groups_with_bot()
@@ -5976,12 +6637,7 @@ def callback_edit_field(call):
                 )
             )
 
-        cursor.execute(
-            "SELECT title FROM managed_groups WHERE chat_id=?",
-            (state["current_group_id"],),
-        )
-        current_group = cursor.fetchone()
-        current_group_title = current_group[0] if current_group else "Неизвестно"
+        current_group_title = state.current_group_title or "Неизвестно"
 
         bot.send_message(
             call.message.chat.id,
@@ -5995,12 +6651,13 @@ def callback_edit_field(call):
     bot.answer_callback_query(call.id, f"Редактирование {field}")
 
 
-def show_media_management_menu(chat_id, state):
-    """Показывает меню управления медиа"""
-    plan_id = state["plan_id"]
-    media_count = len(state.get("media_files", []))
+def show_media_management_menu(chat_id, state, notice=None):
+    """Показывает меню управления медиа (notice - строка-итог над меню)"""
+    plan_id = state.plan_id
+    media_count = len(state.media_files)
 
-    text = f"🖼️ <b>Управление медиа для группы '{state['current_title']}'</b>\n\n"
+    text = f"{notice}\n\n" if notice else ""
+    text += f"🖼️ <b>Управление медиа для группы '{state.current_title}'</b>\n\n"
     text += f"📊 Текущее количество медиа: {media_count}\n\n"
 
     if media_count > 0:
@@ -6038,22 +6695,22 @@ def show_media_management_menu(chat_id, state):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("add_media:")
 )
+@admin_only
 def callback_add_media(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     plan_id = int(call.data.split(":")[1])
     uid = call.from_user.id
 
     state = admin_states.get(uid)
-    if not state or state.get("mode") != "edit" or state.get("plan_id") != plan_id:
+    if not state or state.mode != "edit" or state.plan_id != plan_id:
         bot.answer_callback_query(call.id, "❌ Сессия устарела.")
         return
 
-    state["step"] = "adding_media"
+    state.step = "adding_media"
+    _start_media_upload(state)
 
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    # one_time_keyboard: клавиатура прячется после нажатия кнопки, так что итог
+    # шага можно отправить одним сообщением с inline-меню, без ReplyKeyboardRemove
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
     markup.row(types.KeyboardButton("✅ Завершить добавление медиа"))
     markup.row(types.KeyboardButton("🔙 Назад к управлению медиа"))
 
@@ -6068,33 +6725,55 @@ def callback_add_media(call):
     bot.answer_callback_query(call.id, "Добавление медиа...")
 
 
+# Кэш превью-альбомов редактора: {plan_id: ((media_type, file_ids), [InputMedia...])}
+_media_group_cache = {}
+
+
+def _invalidate_media_group(plan_id):
+    """Сбрасывает кэш превью-альбома группы обучения"""
+    _media_group_cache.pop(plan_id, None)
+
+
+def get_preview_media_group(plan_id, media_type, file_ids):
+    """Возвращает собранный список InputMedia для превью (кэшируется по plan_id)"""
+    key = (media_type, tuple(file_ids))
+    cached = _media_group_cache.get(plan_id)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    if media_type == "photo":
+        media_group = [types.InputMediaPhoto(file_id) for file_id in file_ids]
+    elif media_type == "video":
+        media_group = [types.InputMediaVideo(file_id) for file_id in file_ids]
+    else:
+        media_group = []
+    _media_group_cache[plan_id] = (key, media_group)
+    return media_group
+
+
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("clear_media:")
 )
+@admin_only
 def callback_clear_media(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     plan_id = int(call.data.split(":")[1])
     uid = call.from_user.id
 
     state = admin_states.get(uid)
-    if not state or state.get("mode") != "edit" or state.get("plan_id") != plan_id:
+    if not state or state.mode != "edit" or state.plan_id != plan_id:
         bot.answer_callback_query(call.id, "❌ Сессия устарела.")
         return
 
     # Удаляем все медиа из базы
-    cursor.execute("DELETE FROM plan_media WHERE plan_id=?", (plan_id,))
-    cursor.execute(
-        "UPDATE plans SET media_file_id=NULL, media_file_ids=NULL, media_type=NULL WHERE id=?",
-        (plan_id,),
-    )
-    conn.commit()
+    with conn:
+        conn.execute(_SQL_DELETE_PLAN_MEDIA, (plan_id,))
+        conn.execute(_SQL_UPDATE_PLAN_MEDIA, (None, None, None, plan_id))
+    _invalidate_media_group(plan_id)
 
     # Обновляем состояние
-    state["media_files"] = []
-    state["media_type"] = None
+    state.media_files = []
+    state.media_type = None
+    state.saved_media_key = (None, ())
 
     bot.answer_callback_query(call.id, "✅ Все медиа удалены!")
 
@@ -6105,22 +6784,19 @@ def callback_clear_media(call):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("view_current_media:")
 )
+@admin_only
 def callback_view_current_media(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     plan_id = int(call.data.split(":")[1])
     uid = call.from_user.id
 
     state = admin_states.get(uid)
-    if not state or state.get("mode") != "edit" or state.get("plan_id") != plan_id:
+    if not state or state.mode != "edit" or state.plan_id != plan_id:
         bot.answer_callback_query(call.id, "❌ Сессия устарела.")
         return
 
-    # Отправляем текущие медиа
-    media_files = state.get("media_files", [])
-    media_type = state.get("media_type")
+    # Отправляем текущие медиа (на шаге загрузки там deque пар - см. _uploaded_media)
+    media_files = _uploaded_media(state)
+    media_type = state.media_type
 
     if not media_files:
         bot.answer_callback_query(call.id, "📭 Нет медиа для просмотра")
@@ -6145,14 +6821,10 @@ def callback_view_current_media(call):
 
         # Если есть еще медиа, отправляем остальные (ограничим 5)
         if len(media_files) > 1:
-            remaining_media = media_files[1:5]  # Ограничиваем 5 медиа
-            media_group = []
-
-            for file_id in remaining_media:
-                if media_type == "photo":
-                    media_group.append(types.InputMediaPhoto(file_id))
-                elif media_type == "video":
-                    media_group.append(types.InputMediaVideo(file_id))
+            # Ограничиваем 5 медиа
+            media_group = get_preview_media_group(
+                plan_id, media_type, media_files[1:5]
+            )
 
             if media_group:
                 bot.send_media_group(call.message.chat.id, media_group)
@@ -6170,16 +6842,13 @@ def callback_view_current_media(call):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("back_to_edit:")
 )
+@admin_only
 def callback_back_to_edit(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     plan_id = int(call.data.split(":")[1])
     uid = call.from_user.id
 
     state = admin_states.get(uid)
-    if not state or state.get("mode") != "edit" or state.get("plan_id") != plan_id:
+    if not state or state.mode != "edit" or state.plan_id != plan_id:
         bot.answer_callback_query(call.id, "❌ Сессия устарела.")
         return
 
@@ -6188,241 +6857,107 @@ def callback_back_to_edit(call):
     bot.answer_callback_query(call.id, "🔙 Назад к редактированию")
 
 
-# Обработчик медиа в режиме добавления
-@bot.message_handler(
-    func=lambda m: m.from_user
-    and m.from_user.id in admin_states
-    and admin_states.get(m.from_user.id, {}).get("mode") == "edit"
-    and admin_states.get(m.from_user.id, {}).get("step") == "adding_media"
-    and m.chat.type == "private"
+# Запросы к медиа групп обучения, общие для создания, редактирования и удаления
+_SQL_UPDATE_PLAN_MEDIA = (
+    "UPDATE plans SET media_file_id=?, media_file_ids=?, media_type=? WHERE id=?"
+)
+_SQL_DELETE_PLAN_MEDIA = "DELETE FROM plan_media WHERE plan_id=?"
+_SQL_INSERT_PLAN_MEDIA = (
+    "INSERT INTO plan_media (plan_id, file_id, media_type, ord, added_ts) VALUES "
 )
-def handle_adding_media(message):
-    uid = message.from_user.id
-    state = admin_states.get(uid)
-
-    if not state or state.get("chat_id") != message.chat.id:
-        return
-
-    if message.photo:
-        file_id = message.photo[-1].file_id
-        state.setdefault("media_files", []).append(file_id)
-        state["media_type"] = "photo"
-        bot.send_message(
-            message.chat.id, f"✅ Фото добавлено! Всего: {len(state['media_files'])}"
-        )
-        return
-
-    if message.video:
-        file_id = message.video.file_id
-        state.setdefault("media_files", []).append(file_id)
-        state["media_type"] = "video"
-        bot.send_message(
-            message.chat.id, f"✅ Видео добавлено! Всего: {len(state['media_files'])}"
-        )
-        return
-
-    if message.text:
-        txt = message.text.strip()
-        if txt == "✅ Завершить добавление медиа":
-            # Сохраняем новые медиа
-            media_files = state.get("media_files", [])
-            media_type = state.get("media_type")
 
-            if media_files:
-                first_media = media_files[0]
-                media_ids_str = ",".join(media_files)
+# Сколько строк plan_media вставляем одним INSERT ... VALUES (...), (...)
+MEDIA_INSERT_CHUNK = 50
 
-                # Обновляем медиа в базе
-                cursor.execute(
-                    "UPDATE plans SET media_file_id=?, media_file_ids=?, media_type=? WHERE id=?",
-                    (first_media, media_ids_str, media_type, state["plan_id"]),
-                )
 
-                # Очищаем старые медиа и добавляем новые
-                cursor.execute(
-                    "DELETE FROM plan_media WHERE plan_id=?", (state["plan_id"],)
-                )
-                for idx, fid in enumerate(media_files):
-                    cursor.execute(
-                        "INSERT INTO plan_media (plan_id, file_id, media_type, ord, added_ts) VALUES (?, ?, ?, ?, ?)",
-                        (state["plan_id"], fid, media_type, idx, int(time.time())),
-                    )
+@lru_cache(maxsize=None)
+def _plan_media_insert_sql(rows_count):
+    """INSERT в plan_media на rows_count строк (текст запроса кэшируется)"""
+    return _SQL_INSERT_PLAN_MEDIA + ", ".join(["(?, ?, ?, ?, ?)"] * rows_count)
 
-                conn.commit()
 
-                cnt = len(media_files)
-                bot.send_message(
-                    message.chat.id,
-                    f"✅ Медиа обновлены!\n📊 Загружено {cnt} медиа",
-                    reply_markup=types.ReplyKeyboardRemove(),
-                )
-            else:
-                bot.send_message(
-                    message.chat.id,
-                    "✅ Медиа не изменены",
-                    reply_markup=types.ReplyKeyboardRemove(),
-                )
+def _insert_plan_media(plan_id, media_files, media_type, now_ts):
+    """Вставляет медиа группы обучения многострочными INSERT (без commit)"""
+    rows = [
+        (plan_id, file_id, media_type, idx, now_ts)
+        for idx, file_id in enumerate(media_files)
+    ]
+    for start in range(0, len(rows), MEDIA_INSERT_CHUNK):
+        chunk = rows[start : start + MEDIA_INSERT_CHUNK]
+        params = [value for row in chunk for value in row]
+        conn.execute(_plan_media_insert_sql(len(chunk)), params)
 
-            state["step"] = "edit_choice"
-            # Показываем меню управления медиа снова
-            show_media_management_menu(message.chat.id, state)
-            return
 
-        elif txt == "🔙 Назад к управлению медиа":
-            # Возвращаемся к управлению медиа без сохранения
-            state["step"] = "edit_choice"
-            show_media_management_menu(message.chat.id, state)
-            return
-
-        bot.send_message(
-            message.chat.id, "❌ Отправляйте фото или видео, или используйте кнопки"
+def save_plan_media(plan_id, media_files, media_type):
+    """Заменяет медиа группы обучения (plans и plan_media) одной транзакцией"""
+    # with conn: первый UPDATE открывает транзакцию, в конце - один commit
+    # или rollback при ошибке
+    with conn:
+        conn.execute(
+            _SQL_UPDATE_PLAN_MEDIA,
+            (media_files[0], ",".join(media_files), media_type, plan_id),
         )
+        conn.execute(_SQL_DELETE_PLAN_MEDIA, (plan_id,))
+        _insert_plan_media(plan_id, media_files, media_type, int(time.time()))
+    _invalidate_media_group(plan_id)
 
 
-@bot.message_handler(
-    func=lambda m: m.from_user
-    and m.from_user.id in admin_states
-    and admin_states.get(m.from_user.id, {}).get("mode") == "edit"
-    and admin_states.get(m.from_user.id, {}).get("step") == "adding_media"
-    and m.chat.type == "private",
-    content_types=["photo", "video"],
-)
-def handle_edit_media_adding(message):
-    uid = message.from_user.id
-    state = admin_states.get(uid)
-
-    if not state or state.get("chat_id") != message.chat.id:
-        return
-
-    if message.photo:
-        file_id = message.photo[-1].file_id
-        state.setdefault("media_files", []).append(file_id)
-        state["media_type"] = "photo"
-        bot.send_message(
-            message.chat.id, f"✅ Фото добавлено! Всего: {len(state['media_files'])}"
-        )
-        return
-
-    if message.video:
-        file_id = message.video.file_id
-        state.setdefault("media_files", []).append(file_id)
-        state["media_type"] = "video"
-        bot.send_message(
-            message.chat.id, f"✅ Видео добавлено! Всего: {len(state['media_files'])}"
-        )
-        return
+def save_edited_plan_media(state, media_files, media_type):
+    """Сохраняет медиа из редактора, только если они изменились с прошлого сохранения"""
+    media_key = (media_type, tuple(media_files))
+    if state.saved_media_key == media_key:
+        return  # повторное "Завершить" без изменений - писать в базу нечего
+    save_plan_media(state.plan_id, media_files, media_type)
+    state.saved_media_key = media_key
 
 
-# Обработчик медиа в режиме редактирования (используем ту же логику что и при создании)
-@bot.message_handler(
-    func=lambda m: m.from_user
-    and m.from_user.id in admin_states
-    and admin_states.get(m.from_user.id, {}).get("mode") == "edit"
-    and admin_states.get(m.from_user.id, {}).get("step") == "media"
-    and m.chat.type == "private",
-    content_types=["text", "photo", "video"],
-)
-def handle_edit_media(message):
+# Обработчик медиа в режиме добавления
+def handle_adding_media(message):
     uid = message.from_user.id
     state = admin_states.get(uid)
 
-    if not state or state.get("chat_id") != message.chat.id:
+    if not state or state.chat_id != message.chat.id:
         return
 
-    if message.photo:
-        file_id = message.photo[-1].file_id
-        state.setdefault("media_files", []).append(file_id)
-        state["media_type"] = "photo"
-        bot.send_message(
-            message.chat.id, f"✅ Фото добавлено! Всего: {len(state['media_files'])}"
-        )
-        return
-
-    if message.video:
-        file_id = message.video.file_id
-        state.setdefault("media_files", []).append(file_id)
-        state["media_type"] = "video"
-        bot.send_message(
-            message.chat.id, f"✅ Видео добавлено! Всего: {len(state['media_files'])}"
-        )
+    if _append_media(state, message):
+        _schedule_media_ack(message.chat.id, state)
         return
 
     if message.text:
+        # Кнопки шага сами сообщают итог, отложенное подтверждение не нужно
+        _cancel_media_ack(state)
         txt = message.text.strip()
-        if txt == "⏩ Пропустить медиа":
-            # Сохраняем группу без изменений медиа
-            state["step"] = "edit_choice"
-            bot.send_message(
-                message.chat.id,
-                "✅ Медиа не изменены.",
-                reply_markup=types.ReplyKeyboardRemove(),
-            )
-            # Показываем меню редактирования снова
-            show_edit_menu(message.chat.id, state)
-            return
-
         if txt == "✅ Завершить добавление медиа":
             # Сохраняем новые медиа
-            media_files = state.get("media_files", [])
-            media_type = state.get("media_type")
+            media_files = state.media_files = _uploaded_media(state)
+            media_type = state.media_type
 
             if media_files:
-                first_media = media_files[0]
-                media_ids_str = ",".join(media_files)
-
-                # Обновляем медиа в базе
-                cursor.execute(
-                    "UPDATE plans SET media_file_id=?, media_file_ids=?, media_type=? WHERE id=?",
-                    (first_media, media_ids_str, media_type, state["plan_id"]),
-                )
-
-                # Очищаем старые медиа и добавляем новые
-                cursor.execute(
-                    "DELETE FROM plan_media WHERE plan_id=?", (state["plan_id"],)
-                )
-                for idx, fid in enumerate(media_files):
-                    cursor.execute(
-                        "INSERT INTO plan_media (plan_id, file_id, media_type, ord, added_ts) VALUES (?, ?, ?, ?, ?)",
-                        (state["plan_id"], fid, media_type, idx, int(time.time())),
-                    )
-
-                conn.commit()
-
-                cnt = len(media_files)
-                if cnt == 1:
-                    bot.send_message(
-                        message.chat.id,
-                        f"✅ Медиа обновлены! Использовано 1 превью.",
-                        reply_markup=types.ReplyKeyboardRemove(),
-                    )
-                else:
-                    bot.send_message(
-                        message.chat.id,
-                        f"✅ Медиа обновлены! Использовано первое из {cnt} медиа как превью.",
-                        reply_markup=types.ReplyKeyboardRemove(),
-                    )
+                save_edited_plan_media(state, media_files, media_type)
+                notice = f"✅ Медиа обновлены!\n📊 Загружено {len(media_files)} медиа"
             else:
-                bot.send_message(
-                    message.chat.id,
-                    "✅ Медиа не изменены (оставлены предыдущие).",
-                    reply_markup=types.ReplyKeyboardRemove(),
-                )
+                notice = "✅ Медиа не изменены"
 
-            state["step"] = "edit_choice"
-            # Показываем меню редактирования снова
-            show_edit_menu(message.chat.id, state)
+            state.step = "edit_choice"
+            # Итог и меню управления медиа - одним сообщением
+            show_media_management_menu(message.chat.id, state, notice=notice)
+            return
+
+        elif txt == "🔙 Назад к управлению медиа":
+            # Возвращаемся к управлению медиа без сохранения
+            state.step = "edit_choice"
+            state.media_files = _uploaded_media(state)
+            show_media_management_menu(message.chat.id, state)
             return
 
         bot.send_message(
-            message.chat.id,
-            "❌ Отправляйте фото/видео или используйте кнопки '⏩ Пропустить медиа' / '✅ Завершить добавление медиа'.",
+            message.chat.id, "❌ Отправляйте фото или видео, или используйте кнопки"
         )
 
 
-def show_edit_menu(chat_id, state):
-    """Показывает меню редактирования"""
-    plan_id = state["plan_id"]
-
+@lru_cache(maxsize=256)
+def _edit_menu_markup(plan_id):
+    """Клавиатура меню редактирования группы (зависит только от plan_id)"""
     markup = types.InlineKeyboardMarkup()
     markup.row(
         types.InlineKeyboardButton(
@@ -6449,8 +6984,14 @@ def show_edit_menu(chat_id, state):
             "✅ Завершить редактирование", callback_data=f"edit_finish:{plan_id}"
         ),
     )
+    return markup
 
-    text = f"✏️ <b>Редактирование группы:</b> {state['current_title']}\n\nВыберите что хотите изменить:"
+
+def show_edit_menu(chat_id, state):
+    """Показывает меню редактирования"""
+    markup = _edit_menu_markup(state.plan_id)
+
+    text = f"✏️ <b>Редактирование группы:</b> {state.current_title}\n\nВыберите что хотите изменить:"
 
     bot.send_message(chat_id, text, parse_mode="HTML", reply_markup=markup)
 
@@ -6459,27 +7000,24 @@ def show_edit_menu(chat_id, state):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("select_edit_group:")
 )
+@admin_only
 def callback_select_edit_group(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     parts = call.data.split(":")
     group_id = int(parts[1])
     plan_id = int(parts[2])
     uid = call.from_user.id
 
     state = admin_states.get(uid)
-    if not state or state.get("mode") != "edit" or state.get("plan_id") != plan_id:
+    if not state or state.mode != "edit" or state.plan_id != plan_id:
         bot.answer_callback_query(call.id, "❌ Сессия устарела.")
         return
 
-    cursor.execute("UPDATE plans SET group_id=? WHERE id=?", (group_id, plan_id))
-    state["current_group_id"] = group_id
-    conn.commit()
+    with conn:
+        conn.execute("UPDATE plans SET group_id=? WHERE id=?", (group_id, plan_id))
 
-    cursor.execute("SELECT title FROM managed_groups WHERE chat_id=?", (group_id,))
-    group_title = cursor.fetchone()[0]
+    group_title = get_group_title(group_id)
+    state.current_group_id = group_id
+    state.current_group_title = group_title
 
     bot.answer_callback_query(call.id, f"✅ Группа изменена: {group_title}")
 
@@ -6492,19 +7030,19 @@ def callback_select_edit_group(call):
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("edit_finish:")
 )
+@admin_only
 def callback_edit_finish(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен.")
-        return
-
     plan_id = int(call.data.split(":")[1])
     uid = call.from_user.id
 
     state = admin_states.get(uid)
-    if not state or state.get("mode") != "edit" or state.get("plan_id") != plan_id:
+    if not state or state.mode != "edit" or state.plan_id != plan_id:
         bot.answer_callback_query(call.id, "❌ Сессия устарела.")
         return
 
+    # Записываем накопленные правки полей одной транзакцией
+    flush_pending_plan_fields(state)
+
     # Очищаем состояние
     admin_states.pop(uid, None)
 
@@ -6516,33 +7054,44 @@ def callback_edit_finish(call):
     )
 
 
-# Обработчик ввода текстовых данных при редактировании
-@bot.message_handler(
-    func=lambda m: m.from_user
-    and m.from_user.id in admin_states
-    and admin_states.get(m.from_user.id, {}).get("mode") == "edit"
-    and admin_states.get(m.from_user.id, {}).get("step", "").startswith("editing_")
-    and m.chat.type == "private"
-    and m.text
-)
+def flush_pending_plan_fields(state):
+    """Записывает отложенные правки полей группы одним UPDATE"""
+    fields, state.pending_fields = state.pending_fields, {}
+    if not fields:
+        return
+    # Имена колонок берутся только из кода (handle_edit_text_input), не из ввода
+    assignments = ", ".join(f"{column}=?" for column in fields)
+    with conn:
+        conn.execute(
+            f"UPDATE plans SET {assignments} WHERE id=?",
+            (*fields.values(), state.plan_id),
+        )
+
+
+# Подсказка к правкам полей: в базу они попадают только при завершении
+_PENDING_EDIT_HINT = "💾 Сохранится при нажатии «✅ Завершить редактирование»."
+
+
+# Обработчик ввода текстовых данных при редактировании.
+# Правки копятся в state.pending_fields и пишутся в базу при завершении
+# (или при начале другой сессии админа - см. start_admin_session)
 def handle_edit_text_input(message):
     uid = message.from_user.id
     state = admin_states.get(uid)
 
-    if not state or state.get("chat_id") != message.chat.id:
+    if not state or state.chat_id != message.chat.id:
         return
 
-    step = state.get("step", "")
+    step = state.step
     field = step.replace("editing_", "")
 
     if field == "title":
         new_title = message.text.strip()
-        cursor.execute(
-            "UPDATE plans SET title=? WHERE id=?", (new_title, state["plan_id"])
+        state.pending_fields["title"] = new_title
+        state.current_title = new_title
+        bot.send_message(
+            message.chat.id, f"✅ Новое название: {new_title}\n{_PENDING_EDIT_HINT}"
         )
-        state["current_title"] = new_title
-        conn.commit()
-        bot.send_message(message.chat.id, f"✅ Название обновлено: {new_title}")
 
     elif field == "price":
         cents = cents_from_str(message.text)
@@ -6551,30 +7100,61 @@ def handle_edit_text_input(message):
                 message.chat.id, "❌ Неправильный формат цены. Пример: 14.99"
             )
             return
-        cursor.execute(
-            "UPDATE plans SET price_cents=? WHERE id=?", (cents, state["plan_id"])
-        )
-        state["current_price"] = cents
-        conn.commit()
+        state.pending_fields["price_cents"] = cents
+        state.current_price = cents
         bot.send_message(
-            message.chat.id, f"✅ Цена обновлена: {price_str_from_cents(cents)}"
+            message.chat.id,
+            f"✅ Новая цена: {price_str_from_cents(cents)}\n{_PENDING_EDIT_HINT}",
         )
 
     elif field == "description":
         new_description = message.text.strip()
-        cursor.execute(
-            "UPDATE plans SET description=? WHERE id=?",
-            (new_description, state["plan_id"]),
-        )
-        state["current_description"] = new_description
-        conn.commit()
-        bot.send_message(message.chat.id, f"✅ Описание обновлено")
+        state.pending_fields["description"] = new_description
+        state.current_description = new_description
+        bot.send_message(message.chat.id, f"✅ Описание изменено\n{_PENDING_EDIT_HINT}")
 
     # Возвращаемся к меню редактирования
-    state["step"] = "edit_choice"
+    state.step = "edit_choice"
     show_edit_menu(message.chat.id, state)
 
 
+# Шаги редактирования группы: (режим, шаг) -> обработчик сообщения.
+# Шаги editing_<поле> (ввод текста) разбираются в _edit_step_handler
+EDIT_STEP_HANDLERS = {
+    ("edit", "adding_media"): handle_adding_media,
+}
+
+
+def _edit_step_handler(m):
+    """Обработчик для текущего шага редактирования или None"""
+    if not m.from_user or m.chat.type != "private":
+        return None
+    state = admin_states.get(m.from_user.id)
+    if state is None:
+        return None
+    mode, step = state.mode, state.step
+    handler = EDIT_STEP_HANDLERS.get((mode, step))
+    if handler is None and mode == "edit" and step.startswith("editing_") and m.text:
+        handler = handle_edit_text_input
+    return handler
+
+
+def _match_edit_step(m):
+    """Фильтр: находит обработчик шага один раз и запоминает его в сообщении"""
+    m.edit_step_handler = _edit_step_handler(m)
+    return m.edit_step_handler is not None
+
+
+# Один зарегистрированный обработчик вместо отдельного фильтра на каждый шаг
+@bot.message_handler(
+    func=_match_edit_step,
+    content_types=["text", "photo", "video"],
+)
+@admin_only
+def dispatch_edit_step(message):
+    message.edit_step_handler(message)
+
+
 # ----------------- Manual registration command for groups -----------------
 @bot.message_handler(commands=["register_group"])
 def cmd_register_group(message):
@@ -6601,42 +7181,115 @@ def cmd_register_group(message):
     bot.send_message(
         chat.id, "✅ Группа зарегистрирована — бот видит группу и сохранит её в базе."
     )
-    for aid in ADMIN_IDS:
-        try:
-            bot.send_message(
-                aid, f"✅ Группа зарегистрирована: {chat.title} (ID: {chat.id})"
-            )
-        except:
-            pass
+    notify_admins(f"✅ Группа зарегистрирована: {chat.title} (ID: {chat.id})")
 
 
 # ----------------- Graceful shutdown -----------------
+_shutdown_lock = threading.Lock()
+_shutdown_done = False
+
+
 def shutdown():
+    """Останавливает бота и закрывает базу; повторные вызовы ничего не делают"""
+    global _shutdown_done
+    with _shutdown_lock:
+        if _shutdown_done:
+            return
+        _shutdown_done = True
+
+    logging.info("Stopping bot...")
     try:
-        logging.info("Stopping bot...")
         bot.stop_polling()
-    except:
+    except Exception:
         pass
+    # Отложенные правки открытых сессий редактирования не теряем
+    for state in list(admin_states.values()):
+        try:
+            flush_pending_plan_fields(state)
+        except sqlite3.Error:
+            logging.exception("Failed to save pending plan edits")
+    # Фиксируем транзакцию своего потока и закрываем соединения всех потоков:
+    # WAL сбрасывается в базу при закрытии последнего соединения, и при
+    # следующем старте его не придется проигрывать. Чужие транзакции не
+    # коммитим - поток может быть посреди "with conn:", и половина его
+    # изменений попала бы в базу; close() такую транзакцию откатывает
+    own = getattr(_tls, "conn", None)
+    with _all_conns_lock:
+        conns, _all_conns[:] = list(_all_conns), []
+    for db in conns:
+        try:
+            if db is own:
+                db.commit()
+            db.close()
+        except sqlite3.Error:
+            logging.exception("Failed to close database")
+
+
+def _handle_sigterm(signum, frame):
+    shutdown()
+    sys.exit(0)
+
+
+# ----------------- Run polling / webhook -----------------
+ALLOWED_UPDATES = [
+    "message",
+    "edited_message",
+    "callback_query",
+    "my_chat_member",
+    "chat_member",
+    "inline_query",
+    "pre_checkout_query",
+    "shipping_query",
+]
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Принимает обновления от Telegram и передаёт их боту"""
+
+    def do_POST(self):
+        token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            update = types.Update.de_json(self.rfile.read(length).decode("utf-8"))
+        except Exception:
+            logging.warning("Webhook: не удалось разобрать тело запроса")
+            self.send_response(400)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.end_headers()
+        bot.process_new_updates([update])
+
+    def log_message(self, format, *args):
+        pass  # не пишем в лог строку на каждое обновление
+
+
+def run_webhook():
+    bot.remove_webhook()
+    bot.set_webhook(
+        url=WEBHOOK_URL, allowed_updates=ALLOWED_UPDATES, secret_token=WEBHOOK_SECRET
+    )
+    server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), WebhookHandler)
+    logging.info(f"Webhook listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+    server.serve_forever()
 
 
-# ----------------- Run polling -----------------
 if __name__ == "__main__":
     logging.info("Starting student control bot...")
+    atexit.register(shutdown)
+    signal.signal(signal.SIGTERM, _handle_sigterm)
     try:
-        bot.infinity_polling(
-            timeout=60,
-            long_polling_timeout=60,
-            allowed_updates=[
-                "message",
-                "edited_message",
-                "callback_query",
-                "my_chat_member",
-                "chat_member",
-                "inline_query",
-                "pre_checkout_query",
-                "shipping_query",
-            ],
-        )
+        if WEBHOOK_URL:
+            run_webhook()
+        else:
+            bot.infinity_polling(
+                timeout=60, long_polling_timeout=60, allowed_updates=ALLOWED_UPDATES
+            )
     except KeyboardInterrupt:
         shutdown()
     except Exception: